@@ -0,0 +1,742 @@
+"""Reproducible benchmarks of pytriunfo on synthetic documents.
+
+Pólizas and tarjetas are generated with the field layouts of pytriunfo
+(POLIZA_FIELDS, TARJETACIR_FIELDS, TARJETAVER_FIELDS), served by local
+stand-ins of the Triunfo listing pages and of the IMAP server, and every
+stage runs in its own process so its peak RSS is its own:
+
+    scan      fetch_and_scan_emails, latency of each cache_pdf
+    async     the scan with --async, latency of each save_pdf of the writer
+    startup   a new pytriunfo.py process scanning with no new emails
+    ingest    --ingest of the pólizas, latency of each ingest_task
+    metadata  get_metadata of every document
+    extract   --extract of the scanned database, latency of each extract_file
+    excel     --excel of the scanned database
+    codec     --recompress of the scanned database with each blob codec, bytes
+              and latency of decoding each delta and listing, after checking
+              that xref deltas rebuild objects that change kind or number
+
+Usage:
+    py benchmark.py [--sizes 1000,10000,100000] [--stages scan,extract]
+                    [--workdir benchmark] [--output benchmark.json]
+                    [--compare previous.json]
+"""
+import argparse
+import email.utils
+import http.server
+import imaplib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from contextlib import redirect_stdout
+
+import fitz
+import requests
+
+import pytriunfo
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SIZES = (1000, 10000, 100000)
+STAGES = ("scan", "async", "startup", "ingest", "metadata", "extract", "excel", "codec")
+STARTUP_RUNS = 5
+STARTUP_TARGET = 0.25  # seconds of a scan with no new emails, imports included
+# the codec stage stores the scanned blobs as: name, BLOB_CODEC, dictionaries
+CODEC_VARIANTS = (  # name, BLOB_CODEC, dictionaries, delta format
+    ("none", None, False, "bsdiff"),
+    ("zstd", "zstd", False, "bsdiff"),
+    ("zstd+dict", "zstd", True, "bsdiff"),
+    ("xref+dict", "zstd", True, "xref"),
+)
+# every email links to a listing with one document of each type
+URLTYPES = ("hpolizapd", "htarjetacirpd", "htarjetaverpd")
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+TEMPLATE_CHANGE = 2500  # documents between changes of the fixed text
+LISTING_URL = "https://l.triunfonet.com.ar/gauswebtriunfo/aviso?n={}"
+DOCUMENT_URL = "https://www.triunfonet.com.ar/gauswebtriunfo/servlet/{}?id={:06d}"
+
+
+def write_pdf(texts, width=PAGE_WIDTH, height=PAGE_HEIGHT):
+    """Returns a one page PDF with the Helvetica texts, a list of (x, baseline
+    y from the top, fontsize, text). Written by hand, it is ~100x faster than
+    inserting the texts with PyMuPDF."""
+    operators = []
+    for x, y, fontsize, text in texts:
+        text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        operators.append(f"BT /F1 {fontsize:g} Tf {x:g} {height - y:g} Td ({text}) Tj ET")
+    stream = zlib.compress("\n".join(operators).encode("latin-1"))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:g} {height:g}] "
+         "/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>").encode(),
+        b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+
+def field_texts(fields, values, height=PAGE_HEIGHT):
+    """Places the lines of each value inside the clip of its field, with the
+    ink of the glyphs clear of the sides"""
+    texts = []
+    for name, lines in values.items():
+        x0, y0, x1, y1 = pytriunfo.page_clip(fields[name][0], height)
+        line_height = (y1 - y0) / len(lines)
+        for number, line in enumerate(lines):
+            texts.append((x0 + 1, y0 + line_height * (number + 0.75), line_height * 0.7, line))
+    return texts
+
+
+def fixed_texts(i, title):
+    """The text that doesn't change between documents, but for every
+    TEMPLATE_CHANGE documents, like the conditions of a new edition"""
+    edition = i // TEMPLATE_CHANGE
+    texts = [(50, 50, 9, f"TRIUNFO SEGUROS - {title}")]
+    # below every field clip
+    for line in range(14):
+        texts.append((50, 730 + line * 7, 5,
+                      f"Condiciones generales, edición {edition}, cláusula {line}: el asegurador "
+                      "se obliga a resarcir el daño causado por el vehículo asegurado"))
+    return texts
+
+
+def amount(value):
+    return f"{value:,.2f}".replace(",", " ").replace(".", ",").replace(" ", ".")
+
+
+def document_dates(i):
+    return 1 + i % 28, 1 + i % 12, 2015 + i % 10
+
+
+def poliza_pdf(i):
+    day, month, year = document_dates(i)
+    values = {
+        "num_fac": [f"{100000 + i:,}".replace(",", ".")],
+        "patente": [f"AB{i % 1000:03d}CD"],
+        "suplemento": [str(i % 3)],
+        "fecha": [f"{day:02d}/{month:02d}/{year}", f"{day:02d}/{month:02d}/{year + 1}"],
+        "premio": ["$ " + amount(10000 + i % 90000 + 0.37)],
+    }
+    for number, name in enumerate(("prima", "iva", "af", "iva_af", "sellos",
+                                   "otros_imp", "otros_grv", "cuotas_soc")):
+        values[name] = [amount((i * (number + 7)) % 9000 + 0.5)]
+    texts = fixed_texts(i, "PÓLIZA AUTOMOTOR") + field_texts(pytriunfo.POLIZA_FIELDS, values)
+    return write_pdf(texts)
+
+
+def tarjetacir_pdf(i):
+    day, month, year = document_dates(i)
+    values = {"patente": [f"AB{i % 1000:03d}CD"], "fecha": [f"{day:02d}/{month:02d}/{year}"]}
+    texts = fixed_texts(i, "TARJETA DE CIRCULACIÓN") + field_texts(pytriunfo.TARJETACIR_FIELDS, values)
+    return write_pdf(texts)
+
+
+def tarjetaver_pdf(i):
+    day, month, year = document_dates(i)
+    values = {"patente": [f"AB{i % 1000:03d}CD"], "fecha": [f"{day}/{month}/{year}"]}
+    texts = fixed_texts(i, "TARJETA VERDE") + field_texts(pytriunfo.TARJETAVER_FIELDS, values)
+    return write_pdf(texts)
+
+
+DOCUMENT_PDFS = {
+    "hpolizapd": poliza_pdf,
+    "htarjetacirpd": tarjetacir_pdf,
+    "htarjetaverpd": tarjetaver_pdf,
+}
+
+
+def document_urltype(i):
+    return URLTYPES[i % len(URLTYPES)]
+
+
+def document_path(workdir, i):
+    return os.path.join(workdir, "corpus", document_urltype(i), f"{i:06d}.pdf")
+
+
+def generate_corpus(workdir, size):
+    """Writes the documents 0..size-1 that are not in the corpus yet, the
+    corpus of a size is shared by the smaller ones"""
+    for urltype in URLTYPES:
+        os.makedirs(os.path.join(workdir, "corpus", urltype), exist_ok=True)
+    written = 0
+    for i in range(size):
+        path = document_path(workdir, i)
+        if not os.path.exists(path):
+            with open(path, "wb") as filew:
+                filew.write(DOCUMENT_PDFS[document_urltype(i)](i))
+            written += 1
+    return written
+
+
+def email_count(size):
+    return -(-size // len(URLTYPES))
+
+
+def email_message(uid):
+    """The notification email of the listing uid - 1"""
+    listing = LISTING_URL.format(uid - 1)
+    return (
+        "From: avisos@triunfoseguros.com\r\n"
+        f"Date: {email.utils.formatdate(1600000000 + uid * 3600)}\r\n"
+        "Subject: Documentación de su póliza\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: multipart/mixed; boundary=BOUNDARY\r\n\r\n"
+        "--BOUNDARY\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n"
+        f"Puede descargar la documentación en {listing} muchas gracias\r\n"
+        "--BOUNDARY\r\nContent-Type: application/octet-stream\r\n"
+        "Content-Disposition: attachment; filename=logo.png\r\n\r\n"
+        + "QUFBQQ==\r\n" * 64 +
+        "--BOUNDARY--\r\n"
+    ).encode()
+
+
+class TriunfoHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in of the listing pages and PDF servlets. Requests arrive with
+    their original URL in X-Original-Url, see redirect_https."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = self.headers["X-Original-Url"] or ""
+        body = None
+        listing = re.fullmatch(re.escape(LISTING_URL).replace(r"\{\}", r"(\d+)"), url)
+        document = re.search(r"/servlet/(\w+)\?id=(\d+)", url)
+        if listing:
+            first = int(listing[1]) * len(URLTYPES)
+            links = [
+                f"<a href=\"javascript:self.abre('{DOCUMENT_URL.format(document_urltype(i), i)}')\">"
+                f"{document_urltype(i)}</a><br>"
+                for i in range(first, min(first + len(URLTYPES), self.server.size))
+            ]
+            body = ("<html><body>\n" + "\n".join(links) + "\n</body></html>").encode()
+        elif document and int(document[2]) < self.server.size:
+            with open(document_path(self.server.workdir, int(document[2])), "rb") as filer:
+                body = filer.read()
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """Stand-in of an IMAP server with one mailbox, only the commands that
+    fetch_and_scan_emails sends"""
+
+    # replies are written in pieces, Nagle's algorithm would hold them for the ACK
+    disable_nagle_algorithm = True
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode())
+
+    def handle(self):
+        server = self.server
+        self.send("* OK [CAPABILITY IMAP4rev1 CONDSTORE ENABLE] ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, arguments = (line.decode().rstrip("\r\n").split(" ", 2) + [""])[:3]
+            command = command.upper()
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 CONDSTORE ENABLE\r\n")
+            elif command == "LOGOUT":
+                self.send("* BYE\r\n")
+                self.send(f"{tag} OK LOGOUT completed\r\n")
+                return
+            elif command in ("SELECT", "EXAMINE"):
+                self.send(
+                    f"* {server.emails} EXISTS\r\n* FLAGS (\\Seen)\r\n"
+                    "* OK [PERMANENTFLAGS (\\Seen \\*)] ok\r\n* OK [UIDVALIDITY 1] ok\r\n"
+                    f"* OK [UIDNEXT {server.emails + 1}] ok\r\n"
+                    f"* OK [HIGHESTMODSEQ {server.modseq}] ok\r\n"
+                )
+            elif command == "UID":
+                self.uid(*arguments.split(" ", 1))
+            self.send(f"{tag} OK {command} completed\r\n")
+
+    def uid(self, command, arguments):
+        server = self.server
+        command = command.upper()
+        if command == "SEARCH":
+            uids = range(1, server.emails + 1)
+            if "UNKEYWORD PROCESSED" in arguments:
+                uids = [uid for uid in uids if uid not in server.processed]
+            since = re.search(r"UID (\d+):\*", arguments)
+            if since:
+                # n:* always matches the last email
+                uids = [uid for uid in uids if uid >= int(since[1])] or uids[-1:]
+            self.send("* SEARCH " + " ".join(map(str, uids)) + "\r\n")
+        elif command == "FETCH":
+            uid_set, items = arguments.split(" ", 1)
+            for uid in sorted(map(int, uid_set.split(","))):
+                headers, _, text = email_message(uid).partition(b"\r\n\r\n")
+                # the text part and the attachment, see email_message
+                parts = [part.partition(b"\r\n\r\n") for part in text.split(b"--BOUNDARY")[1:3]]
+                if "BODYSTRUCTURE" in items:
+                    self.send(
+                        f"* {uid} FETCH (UID {uid} BODYSTRUCTURE ((\"TEXT\" \"PLAIN\" "
+                        f"(\"CHARSET\" \"utf-8\") NIL NIL \"7BIT\" {len(parts[0][2])} 1 NIL NIL NIL NIL)"
+                        f"(\"APPLICATION\" \"OCTET-STREAM\" NIL NIL NIL \"7BIT\" {len(parts[1][2])} NIL "
+                        "(\"ATTACHMENT\" (\"FILENAME\" \"logo.png\")) NIL NIL) \"MIXED\"))\r\n"
+                    )
+                    continue
+                sections = {
+                    "HEADER.FIELDS": b"\r\n".join(
+                        header for header in headers.split(b"\r\n")
+                        if header.split(b":")[0].upper() == b"FROM"
+                    ) + b"\r\n\r\n",
+                    "1.MIME": parts[0][0].lstrip() + b"\r\n\r\n",
+                    "1": parts[0][2],
+                }
+                response = f"* {uid} FETCH (UID {uid}".encode()
+                for section in re.findall(r"BODY\.PEEK\[([^\] ]*)", items):
+                    response += (f" BODY[{section}] {{{len(sections[section])}}}\r\n".encode()
+                                 + sections[section])
+                self.send(response + b")\r\n")
+        elif command == "STORE":
+            server.processed.update(map(int, arguments.split(" ", 1)[0].split(",")))
+            server.modseq += 1
+
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(workdir, size, connection):
+    """Runs the HTTP and IMAP stand-ins, in their own process so their work
+    isn't measured, and sends back their ports"""
+    http_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), TriunfoHandler)
+    http_server.daemon_threads = True
+    http_server.workdir, http_server.size = workdir, size
+    imap_server = ImapServer(("127.0.0.1", 0), ImapHandler)
+    imap_server.emails, imap_server.processed, imap_server.modseq = email_count(size), set(), 1
+    threading.Thread(target=imap_server.serve_forever, daemon=True).start()
+    connection.send((http_server.server_address[1], imap_server.server_address[1]))
+    http_server.serve_forever()
+
+
+def redirect_https(port):
+    """Sends every https request of requests to the local HTTP stand-in"""
+    send = requests.adapters.HTTPAdapter.send
+
+    def local_send(self, request, **kwargs):
+        request.headers["X-Original-Url"] = request.url
+        request.url = f"http://127.0.0.1:{port}/"
+        return send(self, request, **kwargs)
+
+    requests.adapters.HTTPAdapter.send = local_send
+
+
+def timed(name, latencies):
+    """Replaces the pytriunfo function name by one that appends its duration
+    to latencies, pytriunfo looks its functions up at call time"""
+    function = getattr(pytriunfo, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    setattr(pytriunfo, name, wrapper)
+
+
+def stage_dir(workdir, size, name, fresh=False):
+    path = os.path.join(workdir, str(size), name)
+    if fresh:
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def scanned_dir(workdir, size):
+    path = stage_dir(workdir, size, "scan")
+    if not os.path.exists(os.path.join(path, pytriunfo.DATABASE_FILE)):
+        sys.exit(f"No scanned database for {size} documents, run the scan stage first")
+    return path
+
+
+def bench_scan(workdir, size, latencies, name="scan"):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    servers = multiprocessing.Process(target=serve, args=(workdir, size, sender), daemon=True)
+    servers.start()
+    http_port, imap_port = receiver.recv()
+    try:
+        redirect_https(http_port)
+        # the stand-in doesn't throttle, measure the pipeline and not HOST_RATE
+        pytriunfo.HOST_RATE = None
+        imaplib.IMAP4_SSL = lambda host: imaplib.IMAP4("127.0.0.1", imap_port)
+        os.chdir(stage_dir(workdir, size, name, fresh=True))
+        # the async scan prepares the PDFs in worker processes
+        timed("save_pdf" if pytriunfo.SCAN_ASYNC else "cache_pdf", latencies)
+        pytriunfo.fetch_and_scan_emails()
+        pytriunfo.close_storage()
+    finally:
+        servers.terminate()
+    return size
+
+
+def bench_async(workdir, size, latencies):
+    pytriunfo.SCAN_ASYNC = True
+    return bench_scan(workdir, size, latencies, "async")
+
+
+# the IMAP stand-in replaces the server, nothing else is loaded; pytriunfo is
+# imported rather than run so the compiled module in __pycache__ is reused
+STARTUP_SCRIPT = """import imaplib, sys
+imaplib.IMAP4_SSL = lambda host: imaplib.IMAP4("127.0.0.1", {port})
+sys.path.insert(0, {path!r})
+import pytriunfo
+pytriunfo.main(["scan"])
+"""
+
+
+def bench_startup(workdir, size, latencies):
+    """Runs pytriunfo.py scan, up to date with the checkpoint of the scan stage,
+    in new processes: the cost of a cron run without new emails"""
+    os.chdir(scanned_dir(workdir, size))
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    servers = multiprocessing.Process(target=serve, args=(workdir, size, sender), daemon=True)
+    servers.start()
+    _, imap_port = receiver.recv()
+    script = STARTUP_SCRIPT.format(port=imap_port, path=os.path.dirname(os.path.abspath(pytriunfo.__file__)))
+    try:
+        # a first run to write __pycache__, as after the first cron run
+        subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.DEVNULL)
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.DEVNULL)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        servers.terminate()
+    return STARTUP_RUNS
+
+
+def bench_ingest(workdir, size, latencies):
+    files = [document_path(workdir, i) for i in range(0, size, len(URLTYPES))]
+    os.chdir(stage_dir(workdir, size, "ingest", fresh=True))
+    timed("ingest_task", latencies)
+    pytriunfo.ingest(files)
+    pytriunfo.close_storage()
+    return len(files)
+
+
+def bench_metadata(workdir, size, latencies):
+    for i in range(size):
+        doc = fitz.open(document_path(workdir, i))
+        start = time.perf_counter()
+        pytriunfo.get_metadata(DOCUMENT_URL.format(document_urltype(i), i), doc)
+        latencies.append(time.perf_counter() - start)
+        doc.close()
+    return size
+
+
+def bench_extract(workdir, size, latencies):
+    os.chdir(scanned_dir(workdir, size))
+    shutil.rmtree("extracted_pdfs", ignore_errors=True)
+    pytriunfo.create_cache_table()
+    # a full extraction, not an incremental one
+    pytriunfo.get_storage().write("DELETE FROM extraction_manifest")
+    pytriunfo.get_storage().commit()
+    timed("extract_file", latencies)
+    pytriunfo.extract_files()
+    pytriunfo.close_storage()
+    return len(latencies)
+
+
+def bench_excel(workdir, size, latencies):
+    os.chdir(scanned_dir(workdir, size))
+    pytriunfo.excel()
+    rows = pytriunfo.get_storage().fetchone(
+        "SELECT count(*) FROM poliza_metadata WHERE "
+        + pytriunfo.url_range(pytriunfo.PDF_URL + "hpolizapd")
+    )[0]
+    pytriunfo.close_storage()
+    return rows
+
+
+def check_xref_round_trip():
+    """Diffs and patches a PDF whose objects turn from streams to dictionaries
+    and back, and swap numbers, as between versions of the generator.
+    Raises ValueError if an object isn't rebuilt as it was."""
+    base = fitz.open()
+    base.new_page()
+    xrefs = [base.get_new_xref() for _ in range(4)]
+    for number, xref in enumerate(xrefs):
+        base.update_object(xref, f"<< /Type /Thing /N {number} >>")
+        if number % 2 == 0:
+            base.update_stream(xref, b"stream %d\n0 0 m" % number, compress=0)
+    base_bytes = base.tobytes()
+    base_objects = pytriunfo.xref_objects(base)
+    trailer = pytriunfo.xref_trailer(base)
+    new = fitz.open(stream=base_bytes, filetype="pdf")
+    # stream -> dictionary, dictionary -> stream
+    new.update_object(xrefs[0], "<< /Bar 2 /Type /Thing >>")
+    new.update_stream(xrefs[1], b"new stream\n1 1 l", compress=0)
+    # the stream and the dictionary of the base swap numbers
+    new.update_object(xrefs[2], base.xref_object(xrefs[3]))
+    new.update_object(xrefs[3], base.xref_object(xrefs[2]))
+    new.update_stream(xrefs[3], base.xref_stream_raw(xrefs[2]), compress=0)
+    expected = fitz.open(stream=new.tobytes(), filetype="pdf")
+    delta = pytriunfo.xref_diff(base_objects, trailer, expected.tobytes())
+    patched = pytriunfo.xref_patch(base_bytes, base_objects, delta)
+    rebuilt = fitz.open(stream=patched.tobytes(), filetype="pdf")
+    for xref in range(1, expected.xref_length()):
+        objects = [
+            (pytriunfo.without_length(doc.xref_object(xref)),
+             doc.xref_stream_raw(xref) if doc.xref_is_stream(xref) else None)
+            for doc in (expected, rebuilt)
+        ]
+        if objects[0] != objects[1]:
+            raise ValueError(f"xref {xref} rebuilt as {objects[1]}, not {objects[0]}")
+
+
+def decode_blobs(latencies):
+    """Times the decoding of every delta and listing, bases are loaded first"""
+    storage = pytriunfo.get_storage()
+    pytriunfo.export_templates()
+    storage.templates.clear()
+    pytriunfo.load_templates()
+    rows = storage.query(
+        f"SELECT url FROM fetched_content WHERE {pytriunfo.url_range('https://')} ORDER BY rowid"
+    ).fetchall()
+    for url, in rows:
+        row = storage.fetchone(pytriunfo.SELECT_DOCUMENT, (url,))
+        start = time.perf_counter()
+        if url.startswith(LISTING_URL[:28]):
+            json.loads(pytriunfo.decode_blob(storage, row[0], *row[3:]))
+        else:
+            pytriunfo.get_expanded(storage, url, *row)
+        latencies.append(time.perf_counter() - start)
+    return len(rows)
+
+
+def bench_codec(workdir, size, latencies):
+    """Stores the scanned blobs with each of CODEC_VARIANTS, measures their
+    bytes and decode time"""
+    check_xref_round_trip()
+    os.chdir(stage_dir(workdir, size, "codec", fresh=True))
+    shutil.copy(os.path.join(scanned_dir(workdir, size), pytriunfo.DATABASE_FILE), ".")
+    min_samples = pytriunfo.DICT_MIN_SAMPLES
+    variants = []
+    for name, codec, dictionaries, format in CODEC_VARIANTS:
+        pytriunfo.BLOB_CODEC = codec
+        pytriunfo.DICT_MIN_SAMPLES = min_samples if dictionaries else float("inf")
+        start = time.perf_counter()
+        if format == "xref":
+            pytriunfo.repack(format)
+        # new deltas need new dictionaries
+        pytriunfo.recompress(retrain=format == "xref")
+        seconds = time.perf_counter() - start
+        storage = pytriunfo.get_storage()
+        blob_bytes = storage.fetchone(
+            "SELECT (SELECT sum(length(content)) FROM fetched_content) "
+            "+ (SELECT sum(length(content)) FROM delta_bases) "
+            "+ (SELECT coalesce(sum(length(data)), 0) FROM codec_dicts)"
+        )[0]
+        storage.commit()
+        storage.conn.execute("VACUUM")
+        decoded = []
+        documents = decode_blobs(decoded)
+        variants.append({
+            "codec": name,
+            "recompress_seconds": round(seconds, 3),
+            "blob_bytes": blob_bytes,
+            "db_bytes": os.path.getsize(pytriunfo.DATABASE_FILE),
+            "decode_p50_us": round(percentile(decoded, 0.50) * 1e6, 1),
+            "decode_p99_us": round(percentile(decoded, 0.99) * 1e6, 1),
+        })
+    # the result is the last variant
+    latencies.extend(decoded)
+    pytriunfo.close_storage()
+    return documents, {"codecs": variants}
+
+
+STAGE_FUNCTIONS = {
+    "scan": bench_scan,
+    "async": bench_async,
+    "startup": bench_startup,
+    "ingest": bench_ingest,
+    "metadata": bench_metadata,
+    "extract": bench_extract,
+    "excel": bench_excel,
+    "codec": bench_codec,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, None where unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_stage(stage, size, workdir):
+    """Runs a stage in this process, returns its result"""
+    workdir = os.path.abspath(workdir)
+    latencies = []
+    start = time.perf_counter()
+    # pytriunfo prints every URL and file
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        documents = STAGE_FUNCTIONS[stage](workdir, size, latencies)
+    seconds = time.perf_counter() - start
+    # a stage may add its own fields to the result
+    documents, details = documents if isinstance(documents, tuple) else (documents, {})
+    # startup, extract and excel only read the scanned database
+    db_bytes = (
+        os.path.getsize(pytriunfo.DATABASE_FILE) if stage in ("scan", "async", "ingest", "codec") else None
+    )
+    return {
+        "stage": stage,
+        "size": size,
+        "documents": documents,
+        "seconds": round(seconds, 3),
+        "throughput": round(documents / seconds, 2) if seconds else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "db_bytes": db_bytes,
+        "db_bytes_per_doc": round(db_bytes / documents) if db_bytes and documents else None,
+        "peak_rss_bytes": peak_rss(),
+        **details,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pymupdf": fitz.VersionBind,
+        "sqlite": sqlite3.sqlite_version,
+        "delta_format": pytriunfo.DELTA_FORMAT,
+        "blob_codec": pytriunfo.BLOB_CODEC,
+    }
+
+
+def print_result(result):
+    def show(value, unit="", scale=1):
+        return "-" if value is None else f"{value / scale:,.1f}{unit}"
+
+    print(
+        f"{result['stage']:<9} {result['size']:>7}  {result['documents']:>7} docs  "
+        f"{show(result['throughput'], '/s'):>10}  p50 {show(result['p50_ms'], ' ms'):>9}  "
+        f"p99 {show(result['p99_ms'], ' ms'):>9}  db/doc {show(result['db_bytes_per_doc'], ' B'):>9}  "
+        f"rss {show(result['peak_rss_bytes'], ' MB', 1 << 20):>9}"
+    )
+    for variant in result.get("codecs", ()):
+        print(
+            f"  {variant['codec']:<10} blobs {variant['blob_bytes'] / result['documents']:>8,.1f} B/doc  "
+            f"db {variant['db_bytes'] / 1e6:>7.2f} MB  decode p50 {variant['decode_p50_us']:>7.1f} us  "
+            f"p99 {variant['decode_p99_us']:>7.1f} us  recompress {variant['recompress_seconds']:.1f} s"
+        )
+
+
+def compare(results, previous):
+    """Prints the change of every result against a previous run"""
+    before = {(result["stage"], result["size"]): result for result in previous["results"]}
+    print(f"Compared with {previous['environment'].get('commit')} of {previous['environment']['date']}:")
+    for result in results:
+        old = before.get((result["stage"], result["size"]))
+        if old is None:
+            continue
+        changes = []
+        for key, label in (("throughput", "throughput"), ("p99_ms", "p99"),
+                           ("db_bytes_per_doc", "db/doc"), ("peak_rss_bytes", "rss")):
+            if result[key] and old[key]:
+                changes.append(f"{label} {result[key] / old[key] - 1:+.1%}")
+        print(f"{result['stage']:<9} {result['size']:>7}  " + "  ".join(changes))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks pytriunfo on synthetic documents.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="documents of each run, comma separated")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma separated stages of {', '.join(STAGES)}")
+    parser.add_argument("--workdir", default="benchmark", help="folder of the documents and databases")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--compare", metavar="JSON", help="results of a previous run to compare with")
+    # a stage run by the parent process, the result goes to stdout
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args.size, args.workdir)))
+        return
+    sizes = [int(size) for size in args.sizes.split(",")]
+    stages = [stage for stage in STAGES if stage in args.stages.split(",")]
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        written = generate_corpus(args.workdir, size)
+        print(f"Corpus of {size} documents, {written} generated in {time.perf_counter() - start:.1f} s")
+        for stage in stages:
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--stage", stage,
+                 "--size", str(size), "--workdir", os.path.abspath(args.workdir)],
+                stdout=subprocess.PIPE, text=True,
+            )
+            if child.returncode:
+                sys.exit(f"The {stage} stage of {size} documents failed")
+            results.append(json.loads(child.stdout.splitlines()[-1]))
+            print_result(results[-1])
+            if stage == "startup" and results[-1]["p50_ms"] > STARTUP_TARGET * 1000:
+                print(f"Startup is over the target of {STARTUP_TARGET * 1000:g} ms")
+    with open(args.output, "w") as filew:
+        json.dump({"environment": environment(), "results": results}, filew, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as filer:
+            compare(results, json.load(filer))
+
+
+if __name__ == "__main__":
+    main()
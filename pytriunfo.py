@@ -1,19 +1,27 @@
-import imaplib
 import email
 import re
-from urllib.parse import urlparse
-import requests
+from urllib.parse import urlparse, parse_qs, quote
 import sqlite3
 import time
 from datetime import date
 from pathlib import Path
 import sys
 import json
-import bsdiff4
-import fitz
 import os
-import openpyxl
 import hashlib 
+import io
+import zlib
+import heapq
+import itertools
+import bisect
+from array import array
+from collections import OrderedDict
+import atexit
+import threading
+import argparse
+# imaplib, requests, bsdiff4, fitz (PyMuPDF), openpyxl, http.server and
+# concurrent.futures are imported by the functions that use them, so each
+# command only pays for the libraries it needs
 
 # --- Configuration ---
 # --- You may need to change the config below---
@@ -28,21 +36,290 @@ MAILBOX = 'INBOX/Some'
 # --- You may not need to change the config below ---
 SENDER_DOMAIN = "triunfoseguros"  # The domain to filter emails from
 DATABASE_FILE = "data.db"
-global_templates = {}
-SELECT_CONTENT = "SELECT content FROM fetched_content WHERE url = ?"
+SELECT_CONTENT = "SELECT content, codec, dict_id FROM fetched_content WHERE url = ?"
+SELECT_DOCUMENT = (
+    "SELECT content, format, base_id, codec, dict_id FROM fetched_content WHERE url = ?"
+)
+SELECT_CACHED = (
+    "SELECT rowid, format, base_id, sha256, codec, dict_id FROM fetched_content WHERE url = ?"
+)
 INSERT = (
-    "INSERT OR IGNORE INTO fetched_content (url, filename, content, fetch_time) VALUES (?, ?, ?, ?)"
+    "INSERT OR IGNORE INTO fetched_content (url, filename, content, fetch_time, format, base_id, "
+    "raw_sha256, sha256, codec, dict_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 )
+PDF_URL = "https://www.triunfonet.com.ar/gauswebtriunfo/servlet/"  # see url_range
+SELECT_BY_RAW_SHA256 = "SELECT url FROM fetched_content WHERE raw_sha256 = ?"
+SELECT_BY_SHA256 = "SELECT url FROM fetched_content WHERE sha256 = ?"
+SELECT_CHUNK = "SELECT data FROM chunks WHERE hash = ?"
+INSERT_CHUNK = (
+    "INSERT INTO chunks (hash, data, refcount) VALUES (?, ?, 1) "
+    "ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1"
+)
+INGEST_URL = "https://www.triunfonet.com.ar/gauswebtriunfo/servlet/hpolizapd?--"
+INGEST_INFLIGHT = 2  # files read ahead per --ingest worker
 REGEX_PDFURL = r"https://www.triunfonet.com.ar/gauswebtriunfo/servlet/(\w+)\?"
+METADATA_FIELDS = (
+    "folder", "name", "fecha_desde", "fecha_hasta", "num_fac", "suplemento",
+    "patente", "premio", "prima", "iva", "af", "iva_af", "sellos", "otros_imp",
+    "otros_grv", "cuotas_soc",
+)
+INSERT_METADATA = (
+    f"INSERT OR REPLACE INTO poliza_metadata (url, {', '.join(METADATA_FIELDS)}) "
+    f"VALUES (?{', ?' * len(METADATA_FIELDS)})"
+)
+SELECT_METADATA = (
+    f"SELECT {', '.join(METADATA_FIELDS)} FROM poliza_metadata WHERE url = ?"
+)
 
-BOLD = openpyxl.styles.Font(bold=True)
-NORMAL = openpyxl.styles.Font(bold=False)
-RIGTH = openpyxl.styles.Alignment(horizontal='right', textRotation=30)
-LEFT = openpyxl.styles.Alignment(horizontal='left', textRotation=30)
-CENTER = openpyxl.styles.Alignment(horizontal='center', textRotation=30)
+# --excel columns: header, named style and width
+EXCEL_COLUMNS = (
+    ('Fecha desde', 'date', 11),
+    ('Fecha hasta', 'date', 11),
+    ('Número póliza', 'number', 11),
+    ('Suplemento', 'text', 4),
+    ('Patente', 'text', 11),
+    ('Total pagado', 'amount', 11),
+    ('Prima', 'amount', 11),
+    ('IVA', 'amount', 11),
+    ('Adic. Financiero', 'amount', 11),
+    ('IVA Adic. Financ.', 'amount', 11),
+    ('Sellos', 'amount', 11),
+    ('Otros Imp.', 'amount', 11),
+    ('Otros Grav.', 'amount', 11),
+    ('Cuotas sociales', 'amount', 11),
+)
 
 DATE_FILTER_SINCE = None #'01-Aug-2025'
 
+# --- PDF storage ---
+# "bsdiff": binary diff against the first PDF of each type (the template)
+# "chunks": content-defined chunks stored once and shared by every PDF
+# "xref": the objects and streams that differ from the base, see xref_diff
+DELTA_FORMAT = "bsdiff"
+CHUNK_MIN = 1024  # chunk sizes in bytes
+CHUNK_MAX = 65536
+CHUNK_DIVISOR = 16  # about one line end in CHUNK_DIVISOR after CHUNK_MIN is a boundary
+CHUNK_HASH_SIZE = 16  # bytes of each chunk reference
+MAX_BASES = 8  # bsdiff bases kept per urltype
+BASE_MIN_SIMILARITY = 0.5  # a PDF less similar than this to every base becomes a new base
+SKETCH_SIZE = 128  # hashes kept in each base sketch
+TEMPLATES_SUFFIX = "-templates"  # expanded bases of each db file, see export_templates
+BLOB_READ_SIZE = 64 * 1024  # bytes of a delta read at a time, see open_blob
+
+# --- Blob codecs, see --recompress ---
+# "zstd": bsdiff deltas, listings and bases compressed with zstandard, the
+# deltas and listings with a dictionary trained for each urltype
+# None: blobs are stored as the delta format writes them
+# Without the zstandard module new blobs are stored as with None.
+BLOB_CODEC = "zstd"
+ZSTD_LEVEL = 9  # 19 is 3% smaller and 13 times slower on the deltas
+DICT_SIZE = 16 * 1024  # bytes of each trained dictionary
+DICT_SAMPLES = 2000  # latest blobs of a urltype its dictionary is trained with
+DICT_MIN_SAMPLES = 100  # urltypes with less blobs get no dictionary
+LISTINGS = "listings"  # the urltype of the l.triunfonet.com.ar listing pages
+codec_lock = threading.Lock()
+
+# --- Reconstructed PDF cache ---
+CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # in-process LRU budget
+CACHE_DIR = None  # i.e. "pdf_cache" to also keep rebuilt PDFs on disk, see --cache-dir
+CACHE_DISK_BYTES = 2 * 1024 * 1024 * 1024  # disk cache budget
+global_pdf_cache = None  # see get_pdf_cache
+
+# --- SQLite tuning ---
+BATCH_SIZE = 1000  # rows written per transaction, see --batch
+CACHE_SIZE = -64000  # page cache, negative values are KiB
+global_storage = None  # see get_storage
+pdf_lock = threading.Lock()
+
+# --- Partitions, see the partitions command ---
+# None: every document in DATABASE_FILE
+# "year": new documents go to a file per year of download, "mailbox": per MAILBOX
+# DATABASE_FILE keeps the catalog, the scan checkpoints and the documents
+# stored before partitioning (the "main" partition).
+PARTITION_BY = None
+PARTITION_FILE = "data-{}.db"
+MAIN_PARTITION = "main"
+global_partitions = None  # name -> Storage of the partitions in the catalog, see get_partitions
+
+# --- Read API, see --get and --serve ---
+API_HOST = "127.0.0.1"
+API_PORT = 8080
+DOCUMENTS_LIMIT = 100  # documents listed by each /polizas request
+
+# --- Scan pipeline ---
+FETCH_BATCH = 50  # emails per UID FETCH and per PROCESSED STORE
+DOWNLOAD_WORKERS = 8  # concurrent HTTP downloads, see --workers
+HOST_CONNECTIONS = 8  # concurrent downloads from each host, PDFs all come from one
+HOST_RATE = 20  # requests per second to each host, None is unlimited, see --rate
+HOST_BURST = 20  # requests a host gets at once after being idle
+HTTP_TIMEOUT = (10, 60)  # seconds to connect and between bytes of the body
+DOWNLOAD_ATTEMPTS = 4  # tries in a run before the URL goes to download_retries
+BACKOFF = 1  # seconds before the first retry, doubled on each one
+BACKOFF_MAX = 60  # longest wait, also for the Retry-After of the server
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRY_DELAY = 3600  # seconds before retrying a download_retries URL, doubled on each run
+RETRY_EXPIRY = 60 * 86400  # the links expire after two months
+DOWNLOAD_CHUNK = 16 * 1024  # bytes read at a time, a body cut short loses the last read
+DOWNLOAD_SPOOL = 1024 * 1024  # bigger bodies are written to a temporary file
+
+# --- Async scan, see --async ---
+SCAN_ASYNC = False
+SCAN_STAGES = {  # stage -> [concurrency, queue size], see --stage
+    "imap": [1, None],  # batches of FETCH_BATCH uids, all queued at the start
+    "urls": [1, 200],  # emails and listing pages to find URLs in
+    "download": [DOWNLOAD_WORKERS, 200],  # URLs, see --workers
+    "prepare": [2, 16],  # PDFs to expand, diff and parse in worker processes, see --jobs
+    "write": [1, 64],  # documents to save, SQLite has a single writer
+}
+# the MIME structure first, to fetch only the part with the text
+FETCH_STRUCTURE = "(BODYSTRUCTURE)"
+# a single part email: the headers needed to decode the body and the body itself
+FETCH_ITEMS = (
+    "(BODY.PEEK[HEADER.FIELDS (FROM MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING)]"
+    " BODY.PEEK[TEXT])"
+)
+# a multipart email: the sender, then the headers and body of its text part
+FETCH_PART = "(BODY.PEEK[HEADER.FIELDS (FROM)] BODY.PEEK[{0}.MIME] BODY.PEEK[{0}])"
+IMAP_TOKEN = re.compile(rb'[()]|"((?:[^"\\]|\\.)*)"|\{\d+\}$|[^\s()"]+')
+
+# --- Stats ---
+STATS_BUCKETS = (0.001, 0.01, 0.1, 1, 10)  # seconds, upper bounds of the --stats histograms
+global_stats = None  # see enable_stats
+
+
+class Stats:
+    """Count, time, bytes in and out, and a histogram of the times of each
+    stage of a run. Shared by the download threads and merged from the
+    --jobs workers."""
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, bytes_in=0, bytes_out=0):
+        bucket = bisect.bisect_left(STATS_BUCKETS, seconds)
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {
+                    "count": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0,
+                    "buckets": [0] * (len(STATS_BUCKETS) + 1),
+                }
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["buckets"][bucket] += 1
+
+    def merge(self, stages):
+        """Adds the stages taken from the Stats of another process"""
+        with self.lock:
+            for stage, other in stages.items():
+                stats = self.stages.setdefault(stage, {
+                    "count": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0,
+                    "buckets": [0] * (len(STATS_BUCKETS) + 1),
+                })
+                for key in ("count", "seconds", "bytes_in", "bytes_out"):
+                    stats[key] += other[key]
+                stats["buckets"] = [a + b for a, b in zip(stats["buckets"], other["buckets"])]
+
+    def take(self):
+        """Returns the stages measured so far and starts again, for the workers"""
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def report(self):
+        labels = [f"<{bound * 1000:g}ms" for bound in STATS_BUCKETS] + ["more"]
+        print(f"{'stage':<16}{'count':>8}{'total s':>10}{'mean ms':>10}"
+              f"{'MB in':>10}{'MB out':>10}  " + " ".join(f"{label:>8}" for label in labels))
+        for stage, stats in sorted(self.stages.items()):
+            print(
+                f"{stage:<16}{stats['count']:>8}{stats['seconds']:>10.2f}"
+                f"{stats['seconds'] / stats['count'] * 1000:>10.2f}"
+                f"{stats['bytes_in'] / 1e6:>10.2f}{stats['bytes_out'] / 1e6:>10.2f}  "
+                + " ".join(f"{count:>8}" for count in stats["buckets"])
+            )
+
+    def prometheus(self):
+        """The stages in the Prometheus text format"""
+        lines = [
+            "# HELP pytriunfo_stage_seconds Time spent in each stage of the run.",
+            "# TYPE pytriunfo_stage_seconds histogram",
+        ]
+        for stage, stats in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(STATS_BUCKETS + ("+Inf",), stats["buckets"]):
+                cumulative += count
+                lines.append(f'pytriunfo_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'pytriunfo_stage_seconds_sum{{stage="{stage}"}} {stats["seconds"]}')
+            lines.append(f'pytriunfo_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for key in ("bytes_in", "bytes_out"):
+            lines.append(f"# HELP pytriunfo_stage_{key}_total Bytes {key[6:]} of each stage of the run.")
+            lines.append(f"# TYPE pytriunfo_stage_{key}_total counter")
+            for stage, stats in sorted(self.stages.items()):
+                lines.append(f'pytriunfo_stage_{key}_total{{stage="{stage}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """Writes the stages to a Prometheus text file (.prom) or else JSON"""
+        with open(filename, "w") as filew:
+            if filename.endswith(".prom"):
+                filew.write(self.prometheus())
+            else:
+                json.dump({"buckets": STATS_BUCKETS, "stages": self.stages}, filew, indent=2)
+
+
+class Measure:
+    """Times a with block as a stage, bytes_out may be set inside the block"""
+    __slots__ = ("stage", "bytes_in", "bytes_out", "start")
+
+    def __init__(self, stage, bytes_in=0):
+        self.stage = stage
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global_stats.add(self.stage, time.perf_counter() - self.start, self.bytes_in, self.bytes_out)
+
+
+class NotMeasured:
+    """What measure returns when --stats is off, it does nothing"""
+    __slots__ = ("bytes_out",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NOT_MEASURED = NotMeasured()
+
+
+def measure(stage, bytes_in=0):
+    """Measures a with block as a stage of --stats, i.e.
+    with measure("bsdiff.diff", len(data)) as m: ...; m.bytes_out = len(delta)"""
+    if global_stats is None:
+        return NOT_MEASURED
+    return Measure(stage, bytes_in)
+
+
+def enable_stats():
+    global global_stats
+    if global_stats is None:
+        global_stats = Stats()
+
+
+def take_stats():
+    """Returns and resets the stages measured by a --jobs worker, or None"""
+    return global_stats.take() if global_stats is not None else None
+
+
 def is_valid_url(url):
     """Checks if a string is a potentially valid URL."""
     try:
@@ -52,442 +329,3070 @@ def is_valid_url(url):
         return False
 
 
+class Storage:
+    """Owns the single SQLite connection of a run.
+
+    The database uses WAL journal mode so readers never wait for the writer,
+    and writes are grouped in transactions of batch_size rows. The sqlite3
+    module keeps the compiled statements in its cache, so the constant SQL
+    strings above are prepared once per connection. fetchone, write and
+    commit may be called from the download threads; query returns a live
+    cursor and is meant for the main thread only.
+
+    Each partition has its own Storage, with the bases, sketches and
+    dictionaries read from it. A frozen partition is opened read-only.
+    """
+
+    def __init__(self, filename=None, batch_size=None, name=MAIN_PARTITION, frozen=False):
+        self.filename = filename or DATABASE_FILE
+        self.name = name
+        self.frozen = frozen
+        # a frozen file never changes, SQLite can skip the locks
+        self.uri = (Path(self.filename).absolute().as_uri() + "?mode=ro&immutable=1"
+                    if frozen else self.filename)
+        self.conn = sqlite3.connect(
+            self.uri, cached_statements=256, check_same_thread=False, uri=True
+        )
+        self.lock = threading.RLock()
+        if not frozen:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA cache_size={CACHE_SIZE}")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.batch_size = batch_size or BATCH_SIZE
+        self.pending = 0
+        # urltype (legacy template) or delta_bases id -> expanded PDF, bytes or a
+        # memoryview of the templates sidecar
+        self.templates = {}
+        self.base_objects = {}  # same keys -> the xref_objects of the base
+        self.sketches = {}  # urltype -> list of [base id, sketch] of its bases
+        self.codecs = {}  # codec_dicts id, None without dictionary -> (compressor, decompressor)
+        self.dict_ids = {}  # urltype -> id of its current dictionary, None if it has none
+
+    def query(self, sql, params=()):
+        """Runs a read statement and returns the cursor"""
+        return self.conn.execute(sql, params)
+
+    def fetchone(self, sql, params=()):
+        """Runs a read statement and returns its first row"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        """Runs a read statement and returns all its rows"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        """Runs a write statement, committing every batch_size writes.
+        Returns the rowid of the inserted row."""
+        with self.lock:
+            rowid = self.conn.execute(sql, params).lastrowid
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.commit()
+            return rowid
+
+    def commit(self):
+        with self.lock, measure("sqlite.commit"):
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+
+def get_storage():
+    """Returns the Storage of this process, opening it on first use"""
+    global global_storage
+    if global_storage is None:
+        global_storage = Storage()
+        atexit.register(close_storage)
+    return global_storage
+
+
+def close_storage():
+    """Commits pending writes and closes the Storage of this process and of
+    the partitions"""
+    global global_storage, global_partitions
+    for storage in (global_partitions or {}).values():
+        storage.close()
+    global_partitions = None
+    if global_storage is not None:
+        global_storage.close()
+        global_storage = None
+
+
+def partition_name(fetch_time=None):
+    """Returns the partition of a document downloaded at fetch_time (now by default)"""
+    if PARTITION_BY == "year":
+        return time.strftime("%Y", time.localtime(fetch_time))
+    if PARTITION_BY == "mailbox":
+        return re.sub(r"\W+", "_", MAILBOX).strip("_")
+    return MAIN_PARTITION
+
+
+def document_time(metadata):
+    """The time of the fecha_desde of a document, None if it has none"""
+    try:
+        return time.mktime(time.strptime(metadata["fecha_desde"], "%Y-%m-%d"))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_partitions():
+    """Returns the Storage of every partition, the main file first and then
+    in creation order"""
+    global global_partitions
+    storage = get_storage()
+    with storage.lock:
+        if global_partitions is None:
+            global_partitions = {
+                name: Storage(filename, name=name, frozen=bool(frozen))
+                for name, filename, frozen in storage.fetchall(
+                    "SELECT name, filename, frozen FROM partitions ORDER BY create_time"
+                )
+            }
+        return [storage] + list(global_partitions.values())
+
+
+def get_partition(name, create=False):
+    """Returns the Storage of a partition, creating it if create"""
+    main = get_storage()
+    if name == MAIN_PARTITION:
+        return main
+    # the download threads, or other processes, may create the partition of
+    # a new year at once
+    with main.lock:
+        for storage in get_partitions():
+            if storage.name == name:
+                return storage
+        if create:
+            filename = PARTITION_FILE.format(name)
+            created = Storage(filename, name=name)
+            create_tables(created)
+            created.close()
+            main.write(
+                "INSERT OR IGNORE INTO partitions (name, filename, frozen, create_time) "
+                "VALUES (?, ?, 0, ?)",
+                (name, filename, time.time()),
+            )
+            main.commit()
+        # read the catalog again, another process may have added it
+        row = main.fetchone("SELECT filename, frozen FROM partitions WHERE name = ?", (name,))
+        if row is None:
+            raise ValueError(f"Unknown partition: {name}")
+        storage = global_partitions[name] = Storage(row[0], name=name, frozen=bool(row[1]))
+        return storage
+
+
+def write_partition(fetch_time=None):
+    """Returns the Storage new documents downloaded at fetch_time are written to"""
+    storage = get_partition(partition_name(fetch_time), create=True)
+    if storage.frozen:
+        raise ValueError(f"Partition {storage.name} is frozen, thaw it to add documents")
+    return storage
+
+
+def query_partitions(sql, params=()):
+    """Runs a read statement in every partition, in parallel threads as each
+    partition has its own connection. Returns the rows of each partition, in
+    the order of get_partitions."""
+    partitions = get_partitions()
+    if len(partitions) == 1:
+        return [partitions[0].fetchall(sql, params)]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        return list(executor.map(lambda storage: storage.fetchall(sql, params), partitions))
+
+
+def stream_partitions(sql, params=()):
+    """Runs a read statement in every partition and returns a live cursor of
+    each, in the order of get_partitions, so their rows can be merged without
+    holding them in memory. Main thread only, as Storage.query."""
+    return [storage.query(sql, params) for storage in get_partitions()]
+
+
+def find_row(sql, params=()):
+    """Returns (partition Storage, first row) of a read statement in the
+    first partition where it has rows, or (None, None)"""
+    for storage in get_partitions():
+        row = storage.fetchone(sql, params)
+        if row is not None:
+            return storage, row
+    return None, None
+
+
+def url_partition(url):
+    """Returns the Storage of the partition that holds url, or None"""
+    return find_row("SELECT 1 FROM fetched_content WHERE url = ?", (url,))[0]
+
+
+def query_attached(storage, sql, params=()):
+    """Runs a read statement in the main connection with the partition of
+    storage attached, {part} in sql is the schema of its tables. Joins the
+    tables of the main file (i.e. extraction_manifest) with a partition."""
+    main = get_storage()
+    if storage is main:
+        return main.fetchall(sql.format(part="main"), params)
+    with main.lock:
+        # ATTACH can't run inside a transaction
+        main.commit()
+        main.conn.execute("ATTACH DATABASE ? AS part", (storage.uri,))
+        try:
+            return main.conn.execute(sql.format(part="part"), params).fetchall()
+        finally:
+            main.conn.execute("DETACH DATABASE part")
+
+
+def url_range(prefix, column="url"):
+    """SQL condition of the urls that start with prefix. It is a range of the
+    primary key index, LIKE 'prefix%' can't use it as LIKE is case-insensitive"""
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return f"{column} >= '{prefix}' AND {column} < '{end}'"
+
+
+def url_outside_range(prefix, column="url"):
+    """SQL condition of the urls that don't start with prefix. Two ranges with
+    OR, as NOT (url_range) can't use the index"""
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return f"({column} < '{prefix}' OR {column} >= '{end}')"
+
+
+# legacy templates are keyed by their urltype, the only urls that aren't https://
+TEMPLATE_URLS = url_outside_range("https://")
+
+
+def commit_storage():
+    """Commits the pending writes of the main file and of the partitions"""
+    for storage in get_partitions():
+        if not storage.frozen:
+            storage.commit()
+
+
+def storage_has(url):
+    """Checks if a URL is cached without reading its content"""
+    return url_partition(url) is not None
+
+
+def add_column(cursor, table, column, declaration):
+    """Adds a column to a table created by an older version, if missing"""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
 def create_cache_table():
     """Creates the cache table in SQLite if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    storage = get_storage()
+    create_tables(storage)
+    storage.conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS partitions (
+            name TEXT PRIMARY KEY,
+            filename TEXT,
+            frozen INTEGER,
+            create_time REAL
+        )
+    """
+    )
+    storage.commit()
+
+
+def create_tables(storage):
+    """Creates the tables of a partition, the main file also uses the
+    imap_sync, ingest_progress and extraction_manifest ones"""
+    cursor = storage.conn.cursor()
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS fetched_content (
             url TEXT PRIMARY KEY,
+            filename TEXT,
             content BLOB,
-            fetch_time REAL
+            fetch_time REAL,
+            format TEXT
         )
     """
     )
-    conn.commit()
-    conn.close()
+    # format is NULL for rows cached before it existed, which are bsdiff
+    add_column(cursor, "fetched_content", "format", "TEXT")
+    # bsdiff base, NULL is the first PDF of the urltype (the legacy template)
+    add_column(cursor, "fetched_content", "base_id", "INTEGER")
+    # SHA-256 of the downloaded PDF and of its expanded form, see --dedupe
+    add_column(cursor, "fetched_content", "raw_sha256", "TEXT")
+    add_column(cursor, "fetched_content", "sha256", "TEXT")
+    # blob codec, NULL is stored as the format writes it, see --recompress
+    add_column(cursor, "fetched_content", "codec", "TEXT")
+    add_column(cursor, "fetched_content", "dict_id", "INTEGER")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS fetched_content_raw_sha256 ON fetched_content (raw_sha256)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS fetched_content_sha256 ON fetched_content (sha256)"
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS delta_bases (
+            id INTEGER PRIMARY KEY,
+            urltype TEXT,
+            content BLOB,
+            sketch BLOB,
+            create_time REAL
+        )
+    """
+    )
+    add_column(cursor, "delta_bases", "codec", "TEXT")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS codec_dicts (
+            id INTEGER PRIMARY KEY,
+            urltype TEXT,
+            data BLOB,
+            create_time REAL
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chunks (
+            hash BLOB PRIMARY KEY,
+            data BLOB,  -- zlib compressed
+            refcount INTEGER
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS poliza_metadata (
+            url TEXT PRIMARY KEY,
+            folder TEXT,
+            name TEXT,
+            fecha_desde TEXT,
+            fecha_hasta TEXT,
+            num_fac REAL,
+            suplemento TEXT,
+            patente TEXT,
+            premio REAL,
+            prima REAL,
+            iva REAL,
+            af REAL,
+            iva_af REAL,
+            sellos REAL,
+            otros_imp REAL,
+            otros_grv REAL,
+            cuotas_soc REAL
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ingest_progress (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            ingest_time REAL,
+            error TEXT
+        )
+    """
+    )
+    # why a file couldn't be ingested, NULL if it was
+    add_column(cursor, "ingest_progress", "error", "TEXT")
+    # --excel reads the pólizas in date order
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS poliza_metadata_fecha_desde ON poliza_metadata (fecha_desde)"
+    )
+    # --get and --serve look documents up by patente or número de póliza
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS poliza_metadata_patente ON poliza_metadata (patente, fecha_desde)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS poliza_metadata_num_fac ON poliza_metadata (num_fac)"
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS imap_sync (
+            mailbox TEXT PRIMARY KEY,
+            uidvalidity INTEGER,
+            last_uid INTEGER,
+            highestmodseq INTEGER,
+            sync_time REAL
+        )
+    """
+    )
+    # URLs that failed to download, retried by the next scans, see queue_retry
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS download_retries (
+            url TEXT PRIMARY KEY,
+            mailbox TEXT,
+            attempts INTEGER,
+            error TEXT,
+            first_time REAL,
+            next_time REAL
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS extraction_manifest (
+            url TEXT PRIMARY KEY,
+            path TEXT,
+            sha256 TEXT,
+            size INTEGER,
+            mtime REAL,
+            extract_time REAL
+        )
+    """
+    )
+    storage.commit()
+
+
+def split_chunks(data):
+    """Splits data in content-defined chunks.
+
+    A boundary is a line end, at least CHUNK_MIN bytes into the chunk, whose
+    preceding 16 bytes hash to a multiple of CHUNK_DIVISOR. Boundaries depend
+    only on the nearby bytes, so an edit changes the chunks around it and the
+    rest of the document still splits the same way. Binary data without line
+    ends is cut every CHUNK_MAX bytes.
+    """
+    chunks = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + CHUNK_MAX, size)
+        pos = data.find(b"\n", start + CHUNK_MIN, end)
+        while pos != -1:
+            if zlib.crc32(data[pos - 16:pos]) % CHUNK_DIVISOR == 0:
+                end = pos + 1
+                break
+            pos = data.find(b"\n", pos + 1, end)
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def compress_chunks(data):
+    """Splits data in chunks, returns a list of (reference, compressed chunk)"""
+    # the expanded PDF streams are plain text, they compress well
+    return [
+        (hashlib.blake2b(chunk, digest_size=CHUNK_HASH_SIZE).digest(), zlib.compress(chunk))
+        for chunk in split_chunks(data)
+    ]
+
+
+def store_chunks(storage, data):
+    """Stores the chunks of data and returns the joined references to them"""
+    refs = []
+    for ref, chunk in compress_chunks(data):
+        storage.write(INSERT_CHUNK, (ref, chunk))
+        refs.append(ref)
+    return b"".join(refs)
+
+
+def load_chunks(storage, refs):
+    """Joins the chunks of a list of references made by store_chunks"""
+    return b"".join(
+        zlib.decompress(storage.fetchone(SELECT_CHUNK, (refs[i:i + CHUNK_HASH_SIZE],))[0])
+        for i in range(0, len(refs), CHUNK_HASH_SIZE)
+    )
+
+
+def blob_codec():
+    """Returns the codec new blobs are stored with"""
+    if BLOB_CODEC == "zstd":
+        try:
+            import zstandard  # noqa: F401, optional
+        except ImportError:
+            return None
+    return BLOB_CODEC
+
+
+def get_codec(storage, dict_id):
+    """Returns the zstd (compressor, decompressor) of a codec_dicts row, dict_id
+    None is without dictionary"""
+    import zstandard
+    codec = storage.codecs.get(dict_id)
+    if codec is None:
+        dictionary = None
+        if dict_id is not None:
+            data = storage.fetchone("SELECT data FROM codec_dicts WHERE id = ?", (dict_id,))[0]
+            dictionary = zstandard.ZstdCompressionDict(data)
+        codec = (
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary),
+            zstandard.ZstdDecompressor(dict_data=dictionary),
+        )
+        storage.codecs[dict_id] = codec
+    return codec
+
+
+def get_dict_id(storage, urltype):
+    """Returns the id of the current dictionary of a urltype, None if it has none"""
+    if urltype not in storage.dict_ids:
+        storage.dict_ids[urltype] = storage.fetchone(
+            "SELECT max(id) FROM codec_dicts WHERE urltype = ?", (urltype,)
+        )[0]
+    return storage.dict_ids[urltype]
+
+
+def encode_blob(storage, data, urltype=None):
+    """Compresses a blob with the codec of blob_codec, returns (blob, codec, dict_id).
+    Uses the dictionary of urltype if it has one, bases have no urltype."""
+    codec = blob_codec()
+    if codec is None:
+        return data, None, None
+    dict_id = get_dict_id(storage, urltype) if urltype else None
+    compressor = get_codec(storage, dict_id)[0]
+    # zstd contexts can't be shared by the download threads
+    with codec_lock, measure("zstd.compress", len(data)) as m:
+        blob = compressor.compress(data)
+        m.bytes_out = len(blob)
+    return blob, codec, dict_id
+
+
+def decode_blob(storage, blob, codec, dict_id=None):
+    """Decompresses a blob made by encode_blob, bytes or opened by open_blob"""
+    if codec is None:
+        return blob_bytes(blob)
+    if codec != "zstd":
+        raise ValueError("Unknown blob codec:", codec)
+    decompressor = get_codec(storage, dict_id)[1]
+    with codec_lock, measure("zstd.decompress", len(blob)) as m:
+        if isinstance(blob, bytes):
+            data = decompressor.decompress(blob)
+        else:
+            with decompressor.stream_reader(
+                blob_reader(blob), read_size=BLOB_READ_SIZE, closefd=False
+            ) as reader:
+                data = reader.read()
+        m.bytes_out = len(data)
+    return data
+
+
+def copy_blob(storage, blob, codec, filew, dict_id=None):
+    """Decompresses a blob made by encode_blob, bytes or opened by open_blob,
+    into a file without holding it whole. Returns the bytes written."""
+    if codec is None:
+        import shutil
+        shutil.copyfileobj(blob_reader(blob), filew, BLOB_READ_SIZE)
+        return len(blob)
+    if codec != "zstd":
+        raise ValueError("Unknown blob codec:", codec)
+    decompressor = get_codec(storage, dict_id)[1]
+    with codec_lock, measure("zstd.decompress", len(blob)) as m:
+        size = decompressor.copy_stream(
+            blob_reader(blob), filew, read_size=BLOB_READ_SIZE, write_size=BLOB_READ_SIZE
+        )[1]
+        m.bytes_out = size
+    return size
+
+
+class BytesBlob(io.BytesIO):
+    """A blob read whole, what open_blob returns without Connection.blobopen"""
+
+    def __len__(self):
+        return len(self.getbuffer())
+
+
+def open_blob(storage, table, rowid, column="content"):
+    """Opens a blob for incremental reading, so a delta goes from the SQLite
+    pages to its decoder BLOB_READ_SIZE bytes at a time instead of being
+    copied whole first. Close it, or use it in a with statement.
+    Before Python 3.11 the blob is read whole."""
+    with storage.lock:
+        if not hasattr(storage.conn, "blobopen"):
+            return BytesBlob(storage.conn.execute(
+                f"SELECT {column} FROM {table} WHERE rowid = ?", (rowid,)
+            ).fetchone()[0])
+        return storage.conn.blobopen(table, column, rowid, readonly=True)
+
+
+def blob_bytes(blob):
+    """Returns the bytes of a blob opened by open_blob, or of bytes"""
+    return blob if isinstance(blob, bytes) else blob_reader(blob).read()
+
+
+def blob_reader(blob):
+    """Returns a file object reading a blob opened by open_blob, or bytes, from the start"""
+    from io import BytesIO
+    if isinstance(blob, bytes):
+        return BytesIO(blob)
+    blob.seek(0)
+    return blob
+
+
+def unpack_patch(patch):
+    """Decompresses the bz2 blocks of a bsdiff patch. The plain blocks compress
+    better with a dictionary and get_expanded applies them without bz2."""
+    import bz2
+    from bsdiff4.core import decode_int64
+    len_control = decode_int64(patch[8:16])
+    len_diff = decode_int64(patch[16:24])
+    control = bz2.decompress(patch[32:32 + len_control])
+    diff = bz2.decompress(patch[32 + len_control:32 + len_control + len_diff])
+    extra = bz2.decompress(patch[32 + len_control + len_diff:])
+    # new size, then the size of the control and diff blocks
+    return (patch[24:32] + len(control).to_bytes(8, "little") + len(diff).to_bytes(8, "little")
+            + control + diff + extra)
+
+
+def pack_patch(unpacked):
+    """Rebuilds the bsdiff patch of unpack_patch"""
+    import bsdiff4.core
+    import bsdiff4.format
+    from io import BytesIO
+    len_dst, tcontrol, diff, extra = read_unpacked(unpacked)
+    patch = BytesIO()
+    bsdiff4.format.write_patch(patch, len_dst, tcontrol, diff, extra)
+    return patch.getvalue()
+
+
+def read_unpacked(unpacked):
+    """Returns the new size, control tuples, diff and extra blocks of an unpacked patch"""
+    from bsdiff4.core import decode_int64
+    len_dst = decode_int64(unpacked[:8])
+    len_control = int.from_bytes(unpacked[8:16], "little")
+    len_diff = int.from_bytes(unpacked[16:24], "little")
+    control = unpacked[24:24 + len_control]
+    tcontrol = [
+        (decode_int64(control[i:i + 8]), decode_int64(control[i + 8:i + 16]),
+         decode_int64(control[i + 16:i + 24]))
+        for i in range(0, len_control, 24)
+    ]
+    diff = unpacked[24 + len_control:24 + len_control + len_diff]
+    return len_dst, tcontrol, diff, unpacked[24 + len_control + len_diff:]
+
+
+def encode_patch(storage, urltype, patch):
+    """Compresses a bsdiff patch like encode_blob, unpacked if it has a codec"""
+    if blob_codec() is None:
+        return patch, None, None
+    return encode_blob(storage, unpack_patch(patch), urltype)
+
+
+def xref_objects(doc):
+    """Returns {xref: (source, raw stream or None)} of the objects of a fitz
+    document, free xrefs have the source null"""
+    objects = {}
+    for xref in range(1, doc.xref_length()):
+        try:
+            source = doc.xref_object(xref, compressed=True)
+        except RuntimeError:
+            source = "null"
+        objects[xref] = (source, doc.xref_stream_raw(xref) if doc.xref_is_stream(xref) else None)
+    return objects
+
+
+def xref_trailer(doc):
+    """Returns the trailer keys of a fitz document and their values"""
+    return {key: doc.xref_get_key(-1, key)[1] for key in doc.xref_get_keys(-1)}
+
+
+def without_length(source):
+    """An object source without its /Length, which update_stream rewrites"""
+    return re.sub(r"/Length[ ]?\d+(?: 0 R)?", "", source)
+
+
+def diff_lines(old, new):
+    """Line diff of two streams, the expanded content streams are text with
+    one operator per line. Returns (ops, data) for patch_lines, data holds
+    the new lines and the changed middles of the replaced lines."""
+    import difflib
+    old_lines = old.split(b"\n")
+    new_lines = new.split(b"\n")
+    ops = []
+    data = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif tag == "replace" and i2 - i1 == j2 - j1:
+            # usually a text field, keep what it shares with the old line
+            for i, line in zip(range(i1, i2), new_lines[j1:j2]):
+                base = old_lines[i]
+                size = min(len(base), len(line))
+                prefix = 0
+                while prefix < size and base[prefix] == line[prefix]:
+                    prefix += 1
+                suffix = 0
+                while suffix < size - prefix and base[-1 - suffix] == line[-1 - suffix]:
+                    suffix += 1
+                ops.append([i, prefix, suffix])
+                data.append(line[prefix:len(line) - suffix])
+        elif j2 > j1:
+            ops.append(j2 - j1)
+            data += new_lines[j1:j2]
+    return ops, b"\n".join(data)
+
+
+def patch_lines(old, ops, data):
+    """Rebuilds the new stream of diff_lines. ops are [i, j] to copy the old
+    lines i to j, n to take n lines of data and [i, prefix, suffix] for the
+    old line i with its middle replaced by a line of data."""
+    old_lines = old.split(b"\n")
+    data_lines = iter(data.split(b"\n"))
+    lines = []
+    for op in ops:
+        if isinstance(op, int):
+            lines += itertools.islice(data_lines, op)
+        elif len(op) == 2:
+            lines += old_lines[op[0]:op[1]]
+        else:
+            base = old_lines[op[0]]
+            lines.append(base[:op[1]] + next(data_lines) + base[len(base) - op[2]:])
+    return b"\n".join(lines)
+
+
+def xref_diff(base_objects, base_trailer, expanded):
+    """Diffs an expanded PDF object by object against the xref_objects and
+    xref_trailer of a base.
+
+    Object numbers and stream offsets moving don't change the delta, only
+    the objects and streams that differ are stored. The delta is a JSON
+    header line {"size", "trailer", "objects"} followed by the data of the
+    streams. Each entry of "objects" is [xref, base xref] for an object
+    equal to another base object, or [xref, source, stream, length]: the new
+    source or null if only /Length changed, the stream as "raw", diff_lines
+    ops, "none" if the object has no stream anymore or null if unchanged,
+    and the bytes it takes of the data.
+    """
+    import fitz
+    doc = fitz.open(stream=expanded, filetype="pdf")
+    objects = xref_objects(doc)
+    trailer = xref_trailer(doc)
+    doc.close()
+    by_content = {}
+    for xref, base_object in base_objects.items():
+        by_content.setdefault(base_object, xref)
+    entries = []
+    data = []
+    for xref, (source, stream) in objects.items():
+        base_source, base_stream = base_objects.get(xref, ("null", None))
+        if (source, stream) == (base_source, base_stream):
+            continue
+        moved = by_content.get((source, stream))
+        if moved:
+            entries.append([xref, moved])
+            continue
+        ops = stream_data = None
+        if stream is None and base_stream is not None:
+            # a stream turned into a dictionary, its source drops /Length
+            ops = "none"
+        elif without_length(source) == without_length(base_source):
+            source = None
+        if stream is not None and stream != base_stream:
+            if base_stream:
+                ops, stream_data = diff_lines(base_stream, stream)
+            else:
+                ops, stream_data = "raw", stream
+        if source is None and ops is None:
+            continue
+        entries.append([xref, source, ops, len(stream_data or b"")])
+        data.append(stream_data or b"")
+    header = {
+        "size": len(objects) + 1,
+        "trailer": {
+            key: trailer.get(key, "null") for key in set(trailer) | set(base_trailer)
+            if key != "Size" and trailer.get(key) != base_trailer.get(key)
+        },
+        "objects": entries,
+    }
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + b"".join(data)
+
+
+def xref_patch(base, base_objects, delta):
+    """Applies a xref_diff delta to a base, returns the fitz document"""
+    import fitz
+    end = delta.index(b"\n")
+    header = json.loads(delta[:end])
+    position = end + 1
+    doc = fitz.open(stream=base, filetype="pdf")
+    while doc.xref_length() < header["size"]:
+        doc.get_new_xref()
+    for xref in range(header["size"], doc.xref_length()):
+        # objects of the base the PDF doesn't have
+        doc.update_object(xref, "null")
+    for entry in header["objects"]:
+        xref = entry[0]
+        if len(entry) == 2:
+            source, stream = base_objects[entry[1]]
+        else:
+            # update_object drops the stream, an unchanged one is set again
+            source, ops, length = entry[1:]
+            stream = base_objects.get(xref, ("null", None))[1]
+            if ops == "none":
+                # update_object below drops the stream of the base
+                stream = None
+            elif ops == "raw":
+                stream = delta[position:position + length]
+            elif ops is not None:
+                stream = patch_lines(stream, ops, delta[position:position + length])
+            position += length
+        if source is not None:
+            doc.update_object(xref, source)
+        if stream is not None:
+            # update_stream removes the /Filter of the deflated images and fonts
+            filters = [(key, doc.xref_get_key(xref, key)) for key in ("Filter", "DecodeParms")]
+            doc.update_stream(xref, stream, compress=0)
+            for key, (kind, value) in filters:
+                if kind != "null":
+                    doc.xref_set_key(xref, key, value)
+    for key, value in header["trailer"].items():
+        doc.xref_set_key(-1, key, value)
+    return doc
+
+
+def get_template(storage, urltype):
+    """Retrieves the template of a urltype, or None if we don't have it yet"""
+    template = storage.templates.get(urltype)
+    if not template:
+        # See if we have a template in db
+        result = storage.fetchone(SELECT_CONTENT, (urltype,))
+        if not result:
+            return None
+        template = decode_blob(storage, *result)
+        # save it in memory
+        storage.templates[urltype] = template
+    return template
+
+
+def get_sketch(data):
+    """Bottom-k MinHash sketch of the lines of an expanded PDF"""
+    return heapq.nsmallest(SKETCH_SIZE, set(map(zlib.crc32, bytes(data).split(b"\n"))))
+
+
+def similarity(a, b):
+    """Estimates the Jaccard similarity of two PDFs from their sketches"""
+    union = heapq.nsmallest(SKETCH_SIZE, set(a) | set(b))
+    both = set(a) & set(b)
+    return sum(1 for h in union if h in both) / len(union) if union else 0.0
+
+
+def get_base_sketches(storage, urltype):
+    """Returns the [base id, sketch] of every base of a urltype, the legacy
+    template has id None"""
+    sketches = storage.sketches.get(urltype)
+    if sketches is None:
+        sketches = []
+        template = get_template(storage, urltype)
+        if template:
+            sketches.append([None, get_sketch(template)])
+        for base_id, sketch in storage.fetchall(
+            "SELECT id, sketch FROM delta_bases WHERE urltype = ?", (urltype,)
+        ):
+            sketches.append([base_id, list(array("I", sketch))])
+        storage.sketches[urltype] = sketches
+    return sketches
+
+
+def get_base(storage, urltype, base_id):
+    """Retrieves the expanded PDF of a base, base_id None is the legacy template"""
+    if base_id is None:
+        return get_template(storage, urltype)
+    base = storage.templates.get(base_id)
+    if not base:
+        base = decode_blob(
+            storage, *storage.fetchone("SELECT content, codec FROM delta_bases WHERE id = ?", (base_id,))
+        )
+        storage.templates[base_id] = base
+    return base
+
+
+def get_base_objects(storage, urltype, base_id):
+    """Returns the xref_objects and xref_trailer of a base, see get_base"""
+    import fitz
+    key = urltype if base_id is None else base_id
+    objects = storage.base_objects.get(key)
+    if objects is None:
+        doc = fitz.open(stream=get_base(storage, urltype, base_id), filetype="pdf")
+        objects = storage.base_objects[key] = (xref_objects(doc), xref_trailer(doc))
+        doc.close()
+    return objects
+
+
+def choose_base(storage, urltype, expanded, create=True):
+    """Returns the (id, content) of the base most similar to an expanded PDF.
+
+    A PDF not similar enough to any base becomes a new one while the
+    urltype has less than MAX_BASES, so the bases follow the changes of the
+    insurer's PDF generator instead of diffing against the first PDF forever.
+    Without create, returns None when the PDF should become a new base.
+    """
+    sketch = get_sketch(expanded)
+    sketches = get_base_sketches(storage, urltype)
+    best_id, best = None, -1.0
+    for base_id, base_sketch in sketches:
+        value = similarity(sketch, base_sketch)
+        if value > best:
+            best_id, best = base_id, value
+    if not sketches or (best < BASE_MIN_SIMILARITY and len(sketches) < MAX_BASES):
+        if not create:
+            # read the bases again next time, the writer is adding one
+            storage.sketches.pop(urltype, None)
+            return None
+        content, codec, _ = encode_blob(storage, expanded)
+        base_id = storage.write(
+            "INSERT INTO delta_bases (urltype, content, sketch, create_time, codec) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (urltype, content, array("I", sketch).tobytes(), time.time(), codec),
+        )
+        sketches.append([base_id, sketch])
+        storage.templates[base_id] = expanded
+        # workers only see committed bases
+        storage.commit()
+        return base_id, expanded
+    return best_id, get_base(storage, urltype, best_id)
+
+
+def diff_pdf(storage, urltype, base_id, base, expanded, format):
+    """Diffs an expanded PDF against a base in format, "bsdiff" or "xref".
+    Returns the (content, codec, dict_id) to store."""
+    if format == "xref":
+        with measure("xref.diff", len(expanded)) as m:
+            delta = xref_diff(*get_base_objects(storage, urltype, base_id), expanded)
+            m.bytes_out = len(delta)
+        return encode_xref(storage, urltype, delta)
+    import bsdiff4
+    with measure("bsdiff.diff", len(expanded)) as m:
+        # a mapped base is copied, see get_expanded
+        patch = bsdiff4.diff(bytes(base), expanded)
+        m.bytes_out = len(patch)
+    return encode_patch(storage, urltype, patch)
+
+
+def encode_xref(storage, urltype, delta):
+    """Compresses a xref_diff delta like encode_blob, with zlib without a codec"""
+    if blob_codec() is None:
+        return zlib.compress(delta), None, None
+    return encode_blob(storage, delta, urltype)
+
+
+def decode_xref(storage, blob, codec, dict_id=None):
+    """Decompresses a delta made by encode_xref, bytes or opened by open_blob"""
+    if codec is not None:
+        return decode_blob(storage, blob, codec, dict_id)
+    if isinstance(blob, bytes):
+        return zlib.decompress(blob)
+    decompressor = zlib.decompressobj()
+    reader = blob_reader(blob)
+    data = [decompressor.decompress(chunk) for chunk in iter(lambda: reader.read(BLOB_READ_SIZE), b"")]
+    return b"".join(data) + decompressor.flush()
+
+
+def get_xref_document(storage, url, content, base_id=None, codec=None, dict_id=None):
+    """Rebuilds the fitz document of a xref row"""
+    urltype = re.search(REGEX_PDFURL, url)[1]
+    base = get_base(storage, urltype, base_id)
+    if not base:
+        raise ValueError("Invalid value of URL, we don't have a template:", url)
+    delta = decode_xref(storage, content, codec, dict_id)
+    with measure("xref.patch", len(delta)):
+        return xref_patch(base, get_base_objects(storage, urltype, base_id)[0], delta)
+
+
+def get_expanded(storage, url, content, format, base_id=None, codec=None, dict_id=None):
+    """Rebuilds the expanded PDF (streams not compressed) of a cached row,
+    content is bytes or opened by open_blob"""
+    import bsdiff4.core
+    import bsdiff4.format
+    if format == "chunks":
+        with measure("chunks.load", len(content)) as m:
+            expanded = load_chunks(storage, blob_bytes(content))
+            m.bytes_out = len(expanded)
+        return expanded
+    if format == "xref":
+        doc = get_xref_document(storage, url, content, base_id, codec, dict_id)
+        expanded = doc.tobytes()
+        doc.close()
+        return expanded
+    # content is a diff of a base
+    urltype = re.search(REGEX_PDFURL, url)[1]
+    template = get_base(storage, urltype, base_id)
+    if not template:
+        # We don't have this template, how? We end this
+        raise ValueError("Invalid value of URL, we don't have a template:", url)
+    # bsdiff4 only patches bytes, a base mapped by load_templates is copied
+    # for as long as the patch takes
+    template = bytes(template)
+    # patch the template with the content
+    if codec is not None:
+        content = decode_blob(storage, content, codec, dict_id)
+    with measure("bsdiff.patch", len(content)) as m:
+        if codec is None:
+            # the bz2 blocks are read one at a time
+            expanded = bsdiff4.core.patch(template, *bsdiff4.format.read_patch(blob_reader(content)))
+        else:
+            expanded = bsdiff4.core.patch(template, *read_unpacked(content))
+        m.bytes_out = len(expanded)
+    return expanded
+
+
+class PdfCache:
+    """Two tier cache of rebuilt PDFs, keyed by the content hash of the row.
+
+    The first tier is an in-process LRU of at most memory_bytes. The second,
+    when directory is set, keeps the PDFs as files and removes the least
+    recently used ones when they add up to more than disk_bytes. Rebuilding
+    (patch and recompress) is the slow part of --extract, so running
+    --extract again, or --excel after it, mostly reads from here.
+    """
+
+    def __init__(self, memory_bytes, directory=None, disk_bytes=0):
+        self.memory = OrderedDict()
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+        self.directory = Path(directory) if directory else None
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.disk_used = sum(f.stat().st_size for f in self.directory.glob("*.pdf"))
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached PDF of key, or None"""
+        with self.lock:
+            content = self.memory.get(key)
+            if content is not None:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return content
+        if self.directory:
+            path = self.directory.joinpath(key + ".pdf")
+            try:
+                content = path.read_bytes()
+                # the mtime orders the disk evictions
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+                self.put_memory(key, content)
+                return content
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, content):
+        """Caches the rebuilt PDF of key in both tiers"""
+        self.put_memory(key, content)
+        if self.directory:
+            path = self.directory.joinpath(key + ".pdf")
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            # atomic, other processes never read a partial file
+            os.replace(tmp, path)
+            with self.lock:
+                self.disk_used += len(content)
+                if self.disk_used > self.disk_bytes:
+                    self.evict_disk()
+
+    def put_memory(self, key, content):
+        with self.lock:
+            if key in self.memory or len(content) > self.memory_bytes:
+                return
+            self.memory[key] = content
+            self.memory_used += len(content)
+            while self.memory_used > self.memory_bytes:
+                _, old = self.memory.popitem(last=False)
+                self.memory_used -= len(old)
+
+    def evict_disk(self):
+        """Removes the least recently used files down to 90% of disk_bytes"""
+        files = sorted(
+            ((f.stat(), f) for f in self.directory.glob("*.pdf")),
+            key=lambda item: item[0].st_mtime,
+        )
+        self.disk_used = sum(stat.st_size for stat, _ in files)
+        for stat, f in files:
+            if self.disk_used <= self.disk_bytes * 0.9:
+                break
+            f.unlink(missing_ok=True)
+            self.disk_used -= stat.st_size
+
+    def report(self, stats=None):
+        """Prints the hit/miss statistics"""
+        stats = stats or self.stats
+        total = sum(stats.values())
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        print(f"PDF cache: {hits}/{total} hits ({stats['memory_hits']} memory, "
+              f"{stats['disk_hits']} disk), {stats['misses']} rebuilt")
+
+
+def get_pdf_cache():
+    """Returns the PdfCache of this process, creating it on first use"""
+    global global_pdf_cache
+    if global_pdf_cache is None:
+        global_pdf_cache = PdfCache(CACHE_MEMORY_BYTES, CACHE_DIR, CACHE_DISK_BYTES)
+    return global_pdf_cache
+
+
+def content_key(storage, rowid, format, base_id, sha256):
+    """Identifies the PDF of a SELECT_CACHED row of storage, the key of the PDF
+    cache and the ETag of --serve"""
+    if sha256:
+        return sha256
+    # rows cached before the hashes existed are keyed by their delta
+    with open_blob(storage, "fetched_content", rowid) as blob:
+        return hashlib.sha256(f"{format}:{base_id}:".encode() + blob_bytes(blob)).hexdigest()
 
 
 def get_cached_content(url):
     """Retrieves cached content for a URL if it exists."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    global global_templates
-    cursor.execute(SELECT_CONTENT, (url,))
-    result = cursor.fetchone()
+    import fitz
+    storage, result = find_row(SELECT_CACHED, (url,))
     if url.startswith("https://l.triunfonet.com.ar/"):
-        conn.close()
-        return json.loads(result[0].decode()) if result else []
+        if result is None:
+            return []
+        with open_blob(storage, "fetched_content", result[0]) as blob:
+            return json.loads(decode_blob(storage, blob, *result[4:]).decode())
     if result is None:
-        conn.close()
         return None
     # ----
     # If url is a PDF
-    # content is a diff of template
-    content = result[0]
-    r = re.search(REGEX_PDFURL, url)
-    if r:
-        urltype = r[1]
-        template = global_templates.get(urltype)
-        if not template:
-            # See if we have a template in db
-            cursor.execute(SELECT_CONTENT, (urltype,))
-            result = cursor.fetchone()
-            if not result:
-                # We don't have this template, how? We end this
-                conn.close()
-                raise ValueError("Invalid value of URL, we don't have a template:", url)
-            conn.close()
-            template = result[0]
-            # save it in memory
-            global_templates[urltype] = template
-        # patch the template with the content
-        patched = bsdiff4.patch(template, content)
+    if re.search(REGEX_PDFURL, url):
+        rowid, format, base_id, sha256, codec, dict_id = result
+        key = content_key(storage, rowid, format, base_id, sha256)
+        cache = get_pdf_cache()
+        compressed = cache.get(key)
+        if compressed is not None:
+            return compressed
+        if format == "xref":
+            # rebuilt object by object, only the streams need compressing
+            with open_blob(storage, "fetched_content", rowid) as content:
+                p = get_xref_document(storage, url, content, base_id, codec, dict_id)
+            with measure("pdf.compress") as m:
+                compressed = p.write(garbage=1, deflate=True)
+                p.close()
+                m.bytes_out = len(compressed)
+            cache.put(key, compressed)
+            return compressed
+        with open_blob(storage, "fetched_content", rowid) as content:
+            patched = get_expanded(storage, url, content, format, base_id, codec, dict_id)
         # compress PDF streams
-        p = fitz.open(stream=patched, filetype="pdf")
-        compressed = p.write( garbage=4,           # Perform garbage collection for maximum cleanup
-                deflate=True,        # Use compression for streams (images etc.)
-                clean=True,          # Clean up unused objects
-                linear=True          # Create a linearized (web-optimized) PDF
-                )
-        p.close()
+        with measure("pdf.compress", len(patched)) as m:
+            p = fitz.open(stream=patched, filetype="pdf")
+            compressed = p.write( garbage=4,           # Perform garbage collection for maximum cleanup
+                    deflate=True,        # Use compression for streams (images etc.)
+                    clean=True,          # Clean up unused objects
+                    linear=True          # Create a linearized (web-optimized) PDF
+                    )
+            p.close()
+            m.bytes_out = len(compressed)
+        cache.put(key, compressed)
         return compressed
     else:
         # unrecognized url, return nothing
-        conn.close()
         return None
 
 
 def cache_content(url, content):
     """Caches the fetched content for a URL."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    global global_templates
-    decompressed = None
+    storage = write_partition()
     if url.startswith("https://l.triunfonet.com.ar/"):
-        cursor.execute(INSERT, (url, None, json.dumps(content).encode(), time.time()))
-        conn.commit()
-        conn.close()
+        blob, codec, dict_id = encode_blob(storage, json.dumps(content).encode(), LISTINGS)
+        storage.write(INSERT, (url, None, blob, time.time(), None, None, None, None, codec, dict_id))
         return
     # ---
     # If the url is as PDF
     r = re.search(REGEX_PDFURL, url)
     if r:
-        urltype = r[1]
-        name = None
-        template = global_templates.get(urltype)
-        if not template:
-            # See if we have a template in db
-            cursor.execute(SELECT_CONTENT, (urltype,))
-            result = cursor.fetchone()
-            if not result:
-                # we don't have this template, we save it
-                # decompress PDF streams (not images nor fonts)
-                p = fitz.open(stream=content, filetype="pdf")
-                decompressed = p.write(expand=1, deflate_images=True, deflate_fonts=True)
-                if '/hpoliza' in url:
-                    name = get_name_poliza(p)[1]
-                p.close()
-                cursor.execute(INSERT, (urltype, None, decompressed, time.time()))
-                res = decompressed
-            else:
-                res = result[0]
-            # we save it in memory
-            global_templates[urltype] = res
-            template = res
-        if not decompressed:
-            # decompress PDF streams (not images nor fonts)
-            p = fitz.open(stream=content, filetype="pdf")
-            decompressed = p.write(expand=1, deflate_images=True, deflate_fonts=True)
-            if '/hpoliza' in url:
-                name = get_name_poliza(p)[1]
-                url += name
-            p.close()
-        content = decompressed
-        # diff the template with the content
-        d = bsdiff4.diff(template, content)
-        # save it
-        cursor.execute(INSERT, (url, name, d, time.time()))
-        conn.commit()
-        conn.close()
+        # PyMuPDF is not thread safe and the first PDF of a type becomes the
+        # template, so the download threads cache PDFs one at a time
+        with pdf_lock:
+            cache_pdf(storage, url, r[1], content)
     # else: we don't save other kinds of url
 
 
-def fetch_and_filter_urls(session, url_to_fetch, find_urls=True):
+def cache_pdf(storage, url, urltype, content):
+    """Stores a PDF in DELTA_FORMAT, with its poliza_metadata"""
+    row = prepare_pdf(storage, url, urltype, content, create_base=True)
+    if row:
+        save_pdf(storage, urltype, row)
+
+
+def prepare_pdf(storage, url, urltype, content, create_base=False):
+    """Does the CPU heavy part of caching a PDF: expand, metadata and diff.
+
+    storage is the partition the PDF is written to, duplicates are looked up
+    in every partition. With storage None it is the partition of the
+    fecha_desde of the document, see document_time. Only reads the db unless
+    create_base, so --ingest workers can run it.
+    Returns a dict for save_pdf, or None if the PDF is already cached.
     """
-    Fetches the content of a given URL using the provided session,
-    checks the cache, and caches successful responses.
+    import fitz
+    name = None
+    raw_sha256 = hashlib.sha256(content).hexdigest()
+    duplicate = find_row(SELECT_BY_RAW_SHA256, (raw_sha256,))[1]
+    if duplicate:
+        print(f"'{url}' is already cached as '{duplicate[0]}'")
+        return None
+    # decompress PDF streams (not images nor fonts)
+    with measure("pdf.expand", len(content)) as m:
+        p = fitz.open(stream=content, filetype="pdf")
+        # keep the /ID, so the same PDF always expands to the same bytes
+        decompressed = p.write(expand=1, deflate_images=True, deflate_fonts=True, no_new_id=True)
+        m.bytes_out = len(decompressed)
+    with measure("pdf.metadata"):
+        metadata = get_metadata(url, p)
+    p.close()
+    if '/hpoliza' in url:
+        name = metadata["name"]
+        url += name
+    if storage_has(url):
+        # INSERT OR IGNORE would drop it, don't count its chunks twice
+        return None
+    sha256 = hashlib.sha256(decompressed).hexdigest()
+    duplicate = find_row(SELECT_BY_SHA256, (sha256,))[1]
+    if duplicate:
+        print(f"'{url}' is already cached as '{duplicate[0]}'")
+        return None
+    row = {
+        "url": url, "name": name, "content": None, "base_id": None, "chunks": [],
+        "expanded": None, "raw_sha256": raw_sha256, "sha256": sha256, "metadata": metadata,
+        "codec": None, "dict_id": None,
+    }
+    if storage is None:
+        try:
+            storage = get_partition(partition_name(document_time(metadata)))
+        except ValueError:
+            # save_pdf creates it, with this PDF as its first base
+            row["expanded"] = decompressed
+            return row
+    if DELTA_FORMAT == "chunks":
+        with measure("chunks.compress", len(decompressed)) as m:
+            row["chunks"] = compress_chunks(decompressed)
+            m.bytes_out = sum(len(data) for _, data in row["chunks"])
+        row["content"] = b"".join(ref for ref, _ in row["chunks"])
+        return row
+    with measure("base.choose"):
+        base = choose_base(storage, urltype, decompressed, create_base)
+    if base is None:
+        # it becomes a new base, only the writer can add it
+        row["expanded"] = decompressed
+        return row
+    # diff the template with the content
+    row["base_id"], template = base
+    row["content"], row["codec"], row["dict_id"] = diff_pdf(
+        storage, urltype, row["base_id"], template, decompressed, DELTA_FORMAT
+    )
+    return row
+
+
+def save_pdf(storage, urltype, row):
+    """Writes a PDF prepared by prepare_pdf"""
+    if storage_has(row["url"]) or find_row(SELECT_BY_SHA256, (row["sha256"],))[1]:
+        # another worker prepared the same PDF
+        return
+    if row["expanded"] is not None:
+        row["base_id"], template = choose_base(storage, urltype, row["expanded"], True)
+        row["content"], row["codec"], row["dict_id"] = diff_pdf(
+            storage, urltype, row["base_id"], template, row["expanded"], DELTA_FORMAT
+        )
+    for ref, data in row["chunks"]:
+        storage.write(INSERT_CHUNK, (ref, data))
+    # save it
+    storage.write(INSERT, (row["url"], row["name"], row["content"], time.time(), DELTA_FORMAT,
+                           row["base_id"], row["raw_sha256"], row["sha256"], row["codec"],
+                           row["dict_id"]))
+    save_metadata(storage, row["url"], row["metadata"])
+
+
+def writable_partitions():
+    """Returns the partitions that are not frozen, the maintenance commands
+    rewrite only these"""
+    partitions = []
+    for storage in get_partitions():
+        if storage.frozen:
+            print(f"Skipping the frozen partition {storage.name}")
+        else:
+            partitions.append(storage)
+    return partitions
+
+
+def dedupe():
+    """Reports cached PDFs with the same content under different URLs"""
+    create_cache_table()
+    for storage in writable_partitions():
+        # rows cached before the hashes existed only get the expanded one
+        cursor = storage.query(
+            f"SELECT url FROM fetched_content WHERE {url_range(PDF_URL)} AND sha256 IS NULL order by rowid"
+        )
+        urls = [result[0] for result in cursor.fetchall()]
+        for number, url in enumerate(urls, 1):
+            expanded = get_expanded(storage, url, *storage.fetchone(SELECT_DOCUMENT, (url,)))
+            storage.write(
+                "UPDATE fetched_content SET sha256 = ? WHERE url = ?",
+                (hashlib.sha256(expanded).hexdigest(), url),
+            )
+            if number % 100 == 0:
+                print(f"Hashed {number}/{len(urls)} documents of {storage.name}")
+        storage.commit()
+    partitions = get_partitions()
+    collisions = 0
+    for column in ("raw_sha256", "sha256"):
+        groups = {}  # digest -> urls
+        for storage in partitions:
+            cursor = storage.query(
+                f"SELECT {column}, group_concat(url, char(10)) FROM fetched_content "
+                f"WHERE {column} IS NOT NULL GROUP BY {column} HAVING count(*) > 1"
+            )
+            for digest, urls in cursor:
+                groups.setdefault(digest, []).extend(urls.split("\n"))
+        # across partitions, each row is looked up in the index of the ones before
+        for i, storage in enumerate(partitions[1:], 1):
+            cursor = storage.query(
+                f"SELECT {column}, url FROM fetched_content WHERE {column} IS NOT NULL"
+            )
+            for digest, url in cursor.fetchall():
+                for earlier in partitions[:i]:
+                    for other, in earlier.fetchall(
+                        f"SELECT url FROM fetched_content WHERE {column} = ?", (digest,)
+                    ):
+                        urls = groups.setdefault(digest, [])
+                        urls += [u for u in (other, url) if u not in urls]
+        for digest, urls in groups.items():
+            collisions += 1
+            print(f"--- {column} {digest} ---")
+            print("\n".join(urls))
+    print(f"{collisions} groups of duplicated documents")
+
+
+def repack(to_format=None):
+    """Re-diffs the bsdiff and xref rows against their most similar base, like
+    git repack. With to_format every row is converted to that format."""
+    create_cache_table()
+    for storage in writable_partitions():
+        cursor = storage.query(
+            f"SELECT url FROM fetched_content WHERE {url_range(PDF_URL)} "
+            "AND (format IS NULL OR format IN ('bsdiff', 'xref')) order by rowid"
+        )
+        urls = [result[0] for result in cursor.fetchall()]
+        repacked = saved = 0
+        for number, url in enumerate(urls, 1):
+            content, format, base_id, codec, dict_id = storage.fetchone(SELECT_DOCUMENT, (url,))
+            urltype = re.search(REGEX_PDFURL, url)[1]
+            expanded = get_expanded(storage, url, content, format, base_id, codec, dict_id)
+            new_id, base = choose_base(storage, urltype, expanded)
+            new_format = to_format or format or "bsdiff"
+            if new_id != base_id or new_format != (format or "bsdiff"):
+                d, codec, dict_id = diff_pdf(storage, urltype, new_id, base, expanded, new_format)
+                if len(d) < len(content) or new_format != (format or "bsdiff"):
+                    storage.write(
+                        "UPDATE fetched_content SET content = ?, format = ?, base_id = ?, "
+                        "codec = ?, dict_id = ? WHERE url = ?",
+                        (d, new_format, new_id, codec, dict_id, url)
+                    )
+                    repacked += 1
+                    saved += len(content) - len(d)
+            if number % 100 == 0:
+                print(f"Repacked {number}/{len(urls)} documents")
+        storage.commit()
+        print(f"Repacked {repacked} of {len(urls)} documents of {storage.name}, "
+              f"diffs are {saved} bytes smaller")
+
+
+def migrate_chunks():
+    """Converts the bsdiff rows to the chunks format"""
+    create_cache_table()
+    for storage in writable_partitions():
+        cursor = storage.query(
+            f"SELECT url FROM fetched_content WHERE {url_range(PDF_URL)} "
+            "AND (format IS NULL OR format = 'bsdiff') order by rowid"
+        )
+        urls = [result[0] for result in cursor.fetchall()]
+        before = after = 0
+        for number, url in enumerate(urls, 1):
+            content, format, base_id, codec, dict_id = storage.fetchone(SELECT_DOCUMENT, (url,))
+            refs = store_chunks(
+                storage, get_expanded(storage, url, content, format, base_id, codec, dict_id)
+            )
+            # chunk references are hashes, they don't compress
+            storage.write(
+                "UPDATE fetched_content SET content = ?, format = 'chunks', codec = NULL, "
+                "dict_id = NULL WHERE url = ?", (refs, url)
+            )
+            before += len(content)
+            after += len(refs)
+            if number % 100 == 0:
+                print(f"Migrated {number}/{len(urls)} documents")
+        storage.commit()
+        chunks = storage.fetchone("SELECT count(*), sum(length(data)) FROM chunks")
+        print(f"Migrated {len(urls)} documents of {storage.name}: {before} bytes of diffs became "
+              f"{after} bytes of references, the chunks table holds {chunks[0]} chunks "
+              f"({chunks[1]} bytes). Run VACUUM to reclaim the space of the diffs.")
+
+
+def blob_urltype(url):
+    """Returns the urltype whose dictionary compresses the blob of a url"""
+    r = re.search(REGEX_PDFURL, url)
+    return r[1] if r else LISTINGS
+
+
+def unpacked_blob(storage, url, content, codec, dict_id, format=None):
+    """Returns the bytes a codec compresses of a delta or listing row: the
+    listing JSON, the xref_diff delta or the unpacked bsdiff patch"""
+    if format == "xref":
+        return decode_xref(storage, content, codec, dict_id)
+    data = decode_blob(storage, content, codec, dict_id)
+    if codec is None and blob_urltype(url) != LISTINGS:
+        data = unpack_patch(data)
+    return data
+
+
+def train_dictionaries(storage, urls, retrain=False):
+    """Trains a dictionary for each urltype of urls without one, or every
+    urltype with retrain, from its DICT_SAMPLES latest blobs. urls is a dict
+    urltype -> list of urls in rowid order. Returns the number trained."""
+    import zstandard
+    trained = 0
+    for urltype, type_urls in urls.items():
+        if len(type_urls) < DICT_MIN_SAMPLES or (get_dict_id(storage, urltype) and not retrain):
+            continue
+        samples = [
+            unpacked_blob(storage, url, *storage.fetchone(
+                "SELECT content, codec, dict_id, format FROM fetched_content WHERE url = ?", (url,)
+            ))
+            for url in type_urls[-DICT_SAMPLES:]
+        ]
+        try:
+            dictionary = zstandard.train_dictionary(DICT_SIZE, samples)
+        except zstandard.ZstdError as e:
+            print(f"No dictionary for {urltype}: {e}")
+            continue
+        storage.dict_ids[urltype] = storage.write(
+            "INSERT INTO codec_dicts (urltype, data, create_time) VALUES (?, ?, ?)",
+            (urltype, dictionary.as_bytes(), time.time()),
+        )
+        trained += 1
+    storage.commit()
+    return trained
+
+
+def recompress(retrain=False):
+    """Rewrites the deltas, listings and bases with the codec of blob_codec.
+
+    Deltas and listings of a urltype use the dictionary of their partition,
+    trained first if it has none (or with retrain). Rows already stored with
+    the current codec and dictionary are skipped, so it can run again as the
+    database grows.
+    """
+    create_cache_table()
+    codec = blob_codec()
+    if codec is None and BLOB_CODEC is not None:
+        print(f"The {BLOB_CODEC} codec needs the zstandard module, see requirements.txt")
+        return 1
+    sizes = {}  # urltype -> [blobs, bytes before, bytes after]
+    trained = dictionaries = 0
+    for storage in writable_partitions():
+        trained += recompress_partition(storage, codec, sizes, retrain)
+        dictionaries += storage.fetchone("SELECT sum(length(data)) FROM codec_dicts")[0] or 0
+    print(f"{'type':<20}{'rewritten':>10}{'MB before':>11}{'MB after':>10}{'saved':>8}")
+    before = after = 0
+    for urltype, (rewritten, type_before, type_after) in sizes.items():
+        before += type_before
+        after += type_after
+        saved = 1 - type_after / type_before if type_before else 0
+        print(f"{urltype:<20}{rewritten:>10}{type_before / 1e6:>11.2f}{type_after / 1e6:>10.2f}"
+              f"{saved:>8.1%}")
+    print(f"Trained {trained} dictionaries, blobs went from {before} to {after} bytes "
+          f"plus {dictionaries} bytes of dictionaries ({before - after - dictionaries} saved). "
+          "Run VACUUM to reclaim the space.")
+    return 0
+
+
+def recompress_partition(storage, codec, sizes, retrain=False):
+    """Does recompress in a partition, adds its bytes to sizes. Returns the
+    number of dictionaries trained."""
+    urls = {}
+    for url, in storage.query(
+        f"SELECT url FROM fetched_content WHERE {url_range('https://')} "
+        "AND (format IS NULL OR format IN ('bsdiff', 'xref')) order by rowid"
+    ).fetchall():
+        urls.setdefault(blob_urltype(url), []).append(url)
+    trained = train_dictionaries(storage, urls, retrain) if codec else 0
+    total = sum(len(type_urls) for type_urls in urls.values())
+    number = 0
+    for urltype, type_urls in urls.items():
+        size = sizes.setdefault(urltype, [0, 0, 0])
+        dict_id = get_dict_id(storage, urltype) if codec else None
+        for url in type_urls:
+            content, old_codec, old_dict_id, format = storage.fetchone(
+                "SELECT content, codec, dict_id, format FROM fetched_content WHERE url = ?", (url,)
+            )
+            blob = content
+            if (old_codec, old_dict_id) != (codec, dict_id):
+                data = unpacked_blob(storage, url, content, old_codec, old_dict_id, format)
+                if codec:
+                    blob = encode_blob(storage, data, urltype)[0]
+                elif format == "xref":
+                    blob = zlib.compress(data)
+                else:
+                    blob = data if urltype == LISTINGS else pack_patch(data)
+                storage.write(
+                    "UPDATE fetched_content SET content = ?, codec = ?, dict_id = ? WHERE url = ?",
+                    (blob, codec, dict_id, url),
+                )
+                size[0] += 1
+            size[1] += len(content)
+            size[2] += len(blob)
+            number += 1
+            if number % 1000 == 0:
+                print(f"Recompressed {number}/{total} blobs of {storage.name}")
+    # templates and bases, without dictionary
+    size = sizes.setdefault("bases", [0, 0, 0])
+    bases = [("fetched_content", "url") + row for row in storage.query(
+        f"SELECT url, content, codec FROM fetched_content WHERE {TEMPLATE_URLS}"
+    ).fetchall()]
+    bases += [("delta_bases", "id") + row for row in storage.query(
+        "SELECT id, content, codec FROM delta_bases"
+    ).fetchall()]
+    for table, key, key_value, content, old_codec in bases:
+        blob = content
+        if old_codec != codec:
+            blob = encode_blob(storage, decode_blob(storage, content, old_codec))[0]
+            storage.write(
+                f"UPDATE {table} SET content = ?, codec = ? WHERE {key} = ?",
+                (blob, codec, key_value),
+            )
+            size[0] += 1
+        size[1] += len(content)
+        size[2] += len(blob)
+    storage.write(
+        "DELETE FROM codec_dicts WHERE id NOT IN "
+        "(SELECT dict_id FROM fetched_content WHERE dict_id IS NOT NULL)"
+    )
+    storage.commit()
+    return trained
+
+
+class TokenBucket:
+    """Lets rate requests per second through, up to burst at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Waits for a token"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Downloader:
+    """Downloads URLs for the scan threads over one pooled session.
+
+    Each host gets at most HOST_CONNECTIONS requests at a time and HOST_RATE
+    per second. Connection errors, timeouts and RETRY_STATUSES are retried
+    DOWNLOAD_ATTEMPTS times with exponential backoff, honoring Retry-After.
+    Bodies are spooled to a temporary file, and a body cut short is resumed
+    with a Range request when the server sent an ETag or Last-Modified.
+    """
+
+    def __init__(self, workers=None):
+        import requests
+        self.session = requests.Session()
+        workers = workers or DOWNLOAD_WORKERS
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.hosts = {}  # netloc -> (semaphore, TokenBucket or None)
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        netloc = urlparse(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = (
+                    threading.BoundedSemaphore(HOST_CONNECTIONS),
+                    TokenBucket(HOST_RATE, HOST_BURST) if HOST_RATE else None,
+                )
+            return self.hosts[netloc]
+
+    def get(self, url):
+        """Returns the body of url, raises the last requests exception if
+        every attempt failed"""
+        import random
+        import tempfile
+        import requests
+        semaphore, bucket = self.host(url)
+        with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL) as body:
+            validator = None  # ETag or Last-Modified of the partial body
+            for attempt in range(DOWNLOAD_ATTEMPTS):
+                try:
+                    with semaphore:
+                        if bucket:
+                            bucket.take()
+                        with measure("http.get") as m, self.request(url, body, validator) as response:
+                            validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                            if validator and validator.startswith("W/"):
+                                validator = None  # If-Range needs a strong ETag
+                            start = body.tell()
+                            # a body cut short raises here, the next attempt resumes it
+                            for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                                body.write(chunk)
+                            m.bytes_out = body.tell() - start
+                            # Content-Length is of the encoded body, requests decodes it
+                            length = response.headers.get("Content-Length")
+                            if length and "Content-Encoding" not in response.headers and \
+                                    body.tell() - start < int(length):
+                                raise requests.exceptions.ChunkedEncodingError(
+                                    f"got {body.tell() - start} of {length} bytes"
+                                )
+                    body.seek(0)
+                    return body.read()
+                except requests.exceptions.RequestException as e:
+                    if attempt == DOWNLOAD_ATTEMPTS - 1 or not is_retryable(e):
+                        raise
+                    delay = retry_after(e)
+                    if delay is None:
+                        delay = BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                    delay = min(delay, BACKOFF_MAX)
+                    resumed = f", resuming at {body.tell()} bytes" if validator and body.tell() else ""
+                    print(f"Retrying '{url}' in {delay:.1f} seconds{resumed}: {e}")
+                    time.sleep(delay)
+
+    def request(self, url, body, validator):
+        """Sends a request of get, asking for the rest of the partial body
+        when it has a validator. Empties the body unless the response
+        resumes it."""
+        headers = {}
+        if validator and body.tell():
+            headers = {"Range": f"bytes={body.tell()}-", "If-Range": validator}
+        response = self.session.get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True)
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code != 206 or not content_range.startswith(f"bytes {body.tell()}-"):
+            # a full body, the server ignored the Range or the file changed
+            body.seek(0)
+            body.truncate()
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+def is_retryable(error):
+    """True for the download errors that may go away: connection errors,
+    timeouts, cut bodies and RETRY_STATUSES"""
+    import requests
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ))
+
+
+def retry_after(error):
+    """Returns the seconds of the Retry-After of an HTTP error, or None"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value and value.isdigit():
+        return int(value)
+    return None
+
+
+def queue_retry(url, error):
+    """Adds a URL that failed to download to download_retries, or reschedules
+    it, doubling RETRY_DELAY with each run it fails"""
+    now = time.time()
+    get_storage().write(
+        "INSERT INTO download_retries (url, mailbox, attempts, error, first_time, next_time) "
+        "VALUES (?, ?, 1, ?, ?, ?) ON CONFLICT (url) DO UPDATE SET "
+        "attempts = attempts + 1, error = excluded.error, "
+        f"next_time = excluded.first_time + {RETRY_DELAY} * (1 << min(attempts, 10))",
+        (url, MAILBOX, str(error), now, now + RETRY_DELAY),
+    )
+
+
+def due_retries():
+    """Returns the download_retries URLs to try again in this scan, dropping
+    the ones older than RETRY_EXPIRY"""
+    storage = get_storage()
+    expired = time.time() - RETRY_EXPIRY
+    for url, attempts, error in storage.fetchall(
+        "SELECT url, attempts, error FROM download_retries WHERE first_time < ?", (expired,)
+    ):
+        print(f"Giving up '{url}' after {attempts} failed scans: {error}")
+    storage.write("DELETE FROM download_retries WHERE first_time < ?", (expired,))
+    return [url for url, in storage.fetchall(
+        "SELECT url FROM download_retries WHERE next_time <= ? ORDER BY first_time", (time.time(),)
+    )]
+
+
+def retry_downloads(executor, downloader, urls):
+    """Downloads the due download_retries URLs again, following listing pages
+    to their PDFs as finish_batch does. A URL that fails again is
+    rescheduled by fetch_and_filter_urls."""
+    from concurrent.futures import FIRST_COMPLETED, wait
+    print(f"Retrying {len(urls)} failed downloads")
+    storage = get_storage()
+    pending = {
+        executor.submit(fetch_and_filter_urls, downloader, url, is_listing(url), False): url
+        for url in urls
+    }
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            url = pending.pop(future)
+            found = future.result()
+            if found is None:
+                continue
+            storage.write("DELETE FROM download_retries WHERE url = ?", (url,))
+            for pdf in found:
+                pending[executor.submit(fetch_and_filter_urls, downloader, pdf, False, False)] = pdf
+    commit_storage()
+
+
+def is_listing(url):
+    return url.startswith("https://l.triunfonet.com.ar")
+
+
+def fetch_and_filter_urls(downloader, url_to_fetch, find_urls=True, follow=True):
+    """
+    Fetches the content of a given URL using the provided downloader,
+    checks the cache, and caches successful responses. A URL that could
+    not be downloaded is added to download_retries.
 
     Args:
-        session (requests.Session): The requests session object for connection pooling.
+        downloader (Downloader): Downloads with per host limits and retries.
         url_to_fetch (str): The URL to retrieve content from.
         find_urls (bool): Parse html content for URLs. If False, only cache content.
+        follow (bool): Also fetch the URLs found. If False, the caller fetches them.
 
     Returns:
         list: A list of valid URLs found in the body of the fetched content,
               or None if an error occurred during fetching.
     """
     found_urls = []
-    content = get_cached_content(url_to_fetch)
+    if find_urls:
+        content = get_cached_content(url_to_fetch)
+    else:
+        # a PDF, we don't need to rebuild it to know it is cached
+        content = storage_has(url_to_fetch)
     if content:
         print(f"Using cached content for '{url_to_fetch}'")
         if find_urls:
             found_urls = content
     else:
-        try:
-            start_time = time.time()
-            response = session.get(url_to_fetch)
-            response.raise_for_status()  # Raise an exception for bad status codes
-            content = response.content
-            end_time = time.time()
-            print(
-                f"Fetched '{url_to_fetch}' in {end_time - start_time:.2f} seconds."
-            )
-            if find_urls:
-                # we save a JSON array of PDF URLs
-                found_urls = find_urls_in_text_javascript(content.decode())
-                if found_urls:
-                    cache_content(url_to_fetch, found_urls)
+        content = fetch_url(downloader, url_to_fetch)
+        if content is None:
+            return None
+        if find_urls:
+            # we save a JSON array of PDF URLs
+            found_urls = find_urls_in_text_javascript(content.decode())
+            if found_urls:
+                cache_content(url_to_fetch, found_urls)
+        else:
+            # PDF
+            cache_content(url_to_fetch, content)
+    if not follow:
+        return found_urls
+    for url in found_urls:
+        # if we have a list of PDF URLs, we download and store them in cache
+        fetch_and_filter_urls(downloader, url, find_urls=False)
+    return found_urls
+
+
+def fetch_url(downloader, url):
+    """Downloads a URL, returns its body or None if it failed. A URL that may
+    work later is added to download_retries, one that won't is removed."""
+    import requests
+    try:
+        start_time = time.time()
+        content = downloader.get(url)
+        end_time = time.time()
+        print(f"Fetched '{url}' in {end_time - start_time:.2f} seconds.")
+        return content
+    except requests.exceptions.RequestException as e:
+        if not is_retryable(e):
+            print(f"Error fetching URL '{url}': {e}")
+            # a retried URL that now fails for good isn't retried again
+            get_storage().write("DELETE FROM download_retries WHERE url = ?", (url,))
+            return None
+        print(f"Error fetching URL '{url}', retrying it on the next scan: {e}")
+        queue_retry(url, e)
+        return None
+
+
+def find_urls_in_text(text):
+    """Finds potential URLs within a text string using regex."""
+    url_pattern = re.compile(
+        r"https?://[^\s<>\[\]\"\']+"
+    )
+    potential_urls = url_pattern.findall(text)
+    valid_urls = [url for url in potential_urls if is_valid_url(url)]
+    return valid_urls
+
+
+def find_urls_in_text_javascript(text):
+    """Finds javascript:self.abre(*) URLs within a text string using regex."""
+    url_pattern = re.compile(r"javascript:self.abre\('(.+)'\)")
+    potential_urls = url_pattern.findall(text)
+    valid_urls = [url for url in potential_urls if is_valid_url(url)]
+    return valid_urls
+
+
+def load_checkpoint(mailbox):
+    """Retrieves the imap_sync checkpoint of a mailbox as a dict, or None"""
+    result = get_storage().fetchone(
+        "SELECT uidvalidity, last_uid, highestmodseq FROM imap_sync WHERE mailbox = ?",
+        (mailbox,),
+    )
+    return dict(zip(("uidvalidity", "last_uid", "highestmodseq"), result)) if result else None
+
+
+def save_checkpoint(sync):
+    """Stores the imap_sync checkpoint of the scanned mailbox"""
+    get_storage().write(
+        "INSERT OR REPLACE INTO imap_sync (mailbox, uidvalidity, last_uid, highestmodseq, "
+        "sync_time) VALUES (?, ?, ?, ?, ?)",
+        (sync["mailbox"], sync["uidvalidity"], sync["last_uid"], sync["highestmodseq"],
+         time.time()),
+    )
+
+
+def select_response(mail, code):
+    """Returns the value of an untagged response code of the last SELECT"""
+    data = mail.response(code)[1][0]
+    return data.decode() if data is not None else None
+
+
+def get_sync_state(mail):
+    """Reads the UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ and PERMANENTFLAGS that
+    the server sent on SELECT, to compare them with the last checkpoint"""
+    uidnext = select_response(mail, "UIDNEXT")
+    highestmodseq = select_response(mail, "HIGHESTMODSEQ")
+    permanentflags = select_response(mail, "PERMANENTFLAGS") or ""
+    return {
+        "mailbox": MAILBOX,
+        "uidvalidity": int(select_response(mail, "UIDVALIDITY")),
+        "uidnext": int(uidnext) if uidnext else None,
+        "highestmodseq": int(highestmodseq) if highestmodseq else None,
+        # servers without custom keywords only rely on the checkpoint
+        "keywords": "\\*" in permanentflags or "PROCESSED" in permanentflags,
+        "last_uid": 0,
+        "stored": False,
+        # the lowest uid that couldn't be fetched, the checkpoint stays below it
+        "failed": None,
+    }
+
+
+def search_uids(mail, sync):
+    """Searches the emails to scan, only the ones above the checkpoint when
+    the mailbox UIDVALIDITY didn't change. Returns a sorted list of uids."""
+    checkpoint = load_checkpoint(MAILBOX)
+    if checkpoint and checkpoint["uidvalidity"] == sync["uidvalidity"]:
+        sync["last_uid"] = checkpoint["last_uid"]
+        if sync["uidnext"] and sync["uidnext"] <= checkpoint["last_uid"] + 1:
+            print("No new emails since last scan")
+            return []
+        if (not sync["uidnext"] and sync["highestmodseq"]
+                and sync["highestmodseq"] == checkpoint["highestmodseq"]):
+            # servers that don't send UIDNEXT, nothing changed at all
+            print("Mailbox unchanged since last scan")
+            return []
+        search_criteria = ["UID", f"{checkpoint['last_uid'] + 1}:*", f'FROM "{SENDER_DOMAIN}"']
+    else:
+        if checkpoint:
+            print(f"UIDVALIDITY of {MAILBOX} changed, scanning all emails")
+        search_criteria = [f'FROM "{SENDER_DOMAIN}"', "UNKEYWORD", "PROCESSED"]
+
+        # Add SINCE criteria if a date is configured
+        if DATE_FILTER_SINCE:
+            search_criteria.append("SINCE")
+            search_criteria.append(DATE_FILTER_SINCE)
+
+    with measure("imap.search"):
+        status, uids = mail.uid("SEARCH", None, *search_criteria)
+    if status != "OK":
+        print(f"Error searching emails: {status}")
+        return None
+    # "n:*" always matches the last email, even when its uid is lower than n
+    return sorted(int(uid) for uid in uids[0].split() if int(uid) > sync["last_uid"])
+
+
+def mark_processed(mail, batch, sync):
+    """Commits the cached content, flags its emails as PROCESSED in one STORE
+    and moves the checkpoint past the batch, up to the first email that
+    couldn't be fetched"""
+    # commit first, an email is never flagged before its documents are saved
+    commit_storage()
+    if batch["flagged"] and sync["keywords"]:
+        with measure("imap.store"):
+            mail.uid("STORE", ",".join(map(str, batch["flagged"])), "+FLAGS", "(PROCESSED)")
+        sync["stored"] = True
+    sync["last_uid"] = max([sync["last_uid"], *(
+        uid for uid in batch["uids"] if sync["failed"] is None or uid < sync["failed"]
+    )])
+    save_checkpoint(sync)
+    get_storage().commit()
+
+
+def get_text_body(msg):
+    """Returns the text/plain body of an email message"""
+    body = None
+    if msg.is_multipart():
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            cdispo = str(part.get("Content-Disposition"))
+
+            # Look for plain text parts and ignore attachments/HTML
+            if ctype == "text/plain" and "attachment" not in cdispo:
+                body = part.get_payload(decode=True).decode(
+                    errors="ignore"
+                )
+    else:
+        payload = msg.get_payload(decode=True)
+        body = payload.decode(errors="ignore") if payload else None
+    return body
+
+
+def parse_imap_lists(data):
+    """Parses an IMAP response as imaplib returns it, with its literals as
+    (prefix, bytes) tuples, into nested lists of bytes with NIL as None"""
+    stack = [[]]
+    for item in data:
+        prefix, literal = item if isinstance(item, tuple) else (item, None)
+        for match in IMAP_TOKEN.finditer(prefix):
+            token = match[0]
+            if token == b"(":
+                stack.append([])
+            elif token == b")":
+                done = stack.pop()
+                stack[-1].append(done)
+            elif token.startswith(b"{"):
+                stack[-1].append(literal)
+            elif token.startswith(b'"'):
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1", match[1]))
+            else:
+                stack[-1].append(None if token.upper() == b"NIL" else token)
+    return stack[0]
+
+
+def text_section(structure, section=""):
+    """Returns the section of a BODYSTRUCTURE get_text_body reads: the last
+    text/plain part that is not an attachment, "TEXT" for a single part
+    email, None if it has no such part"""
+    if not isinstance(structure[0], list):
+        if not section:
+            return "TEXT"
+        media = [(value or b"").upper() for value in structure[:2]]
+        # the disposition comes after the MD5 in the extension data
+        disposition = structure[9] if len(structure) > 9 else None
+        attachment = isinstance(disposition, list) and (disposition[0] or b"").upper() == b"ATTACHMENT"
+        return section if media == [b"TEXT", b"PLAIN"] and not attachment else None
+    found = None
+    # the parts come first, then the subtype and the extension data
+    for number, part in enumerate(itertools.takewhile(lambda p: isinstance(p, list), structure), 1):
+        found = text_section(part, f"{section}.{number}" if section else str(number)) or found
+    return found
+
+
+def parse_fetch(data):
+    """Returns the {"uid": bytes, section: bytes} of each email in the
+    response of a UID FETCH of BODY sections"""
+    # imaplib returns each literal as a (prefix, bytes) tuple and the rest
+    # of the response line as bytes, i.e. for one email:
+    # (b'7 (UID 12 BODY[HEADER.FIELDS (...)] {95}', b'...'),
+    # (b' BODY[TEXT] {2310}', b'...'), b')'
+    messages = []
+    current = None
+    for item in data:
+        prefix = item[0] if isinstance(item, tuple) else item
+        if re.match(rb"\d+ \(", prefix):
+            # a new email, or an unsolicited FETCH (FLAGS) we skip
+            current = {} if isinstance(item, tuple) else None
+            if current is not None:
+                messages.append(current)
+        if current is None:
+            continue
+        uid = re.search(rb"UID (\d+)", prefix)
+        if uid:
+            current["uid"] = uid[1]
+        part = re.search(rb"BODY\[([^\]]*)\]", prefix)
+        if part and isinstance(item, tuple):
+            current[part[1].split(b" ")[0]] = item[1]
+    return [message for message in messages if "uid" in message]
+
+
+def fetch_messages(mail, uids):
+    """Fetches the text of a batch of emails: one UID FETCH of their
+    BODYSTRUCTURE, then one of the section with the text for the emails
+    that have it there (TEXT for single part emails, usually 1 for the
+    others).
+
+    Returns a list of (uid, email.message.Message) with the From header and
+    the text part only, attachments are never downloaded, and the set of
+    uids whose FETCH failed, to scan again next time.
+    """
+    uid_set = ",".join(map(str, uids))
+    sections = {}  # section -> uids of the emails with their text in it
+    messages = []
+    failed = set()
+    size = 0
+    with measure("imap.fetch") as m:
+        status, data = mail.uid("FETCH", uid_set, FETCH_STRUCTURE)
+        if status != "OK":
+            print(f"Error fetching emails {uid_set}: {data}")
+            return [], set(uids)
+        response = parse_imap_lists(data)
+        for items in response:
+            if not isinstance(items, list):
+                continue  # the sequence number of the next response
+            # an unsolicited FETCH (FLAGS) has no UID
+            values = dict(zip(items[::2], items[1::2]))
+            if b"UID" not in values or not isinstance(values.get(b"BODYSTRUCTURE"), list):
+                continue
+            section = text_section(values[b"BODYSTRUCTURE"])
+            if section is None:
+                messages.append((int(values[b"UID"]), email.message_from_bytes(b"")))
             else:
-                # PDF
-                cache_content(url_to_fetch, content)
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching URL '{url_to_fetch}': {e}")
-            return None
-    for url in found_urls:
-        # if we have a list of PDF URLs, we download and store them in cache
-        fetch_and_filter_urls(session, url, find_urls=False)
+                sections.setdefault(section, []).append(values[b"UID"].decode())
+        for section, batch in sections.items():
+            items = FETCH_ITEMS if section == "TEXT" else FETCH_PART.format(section)
+            status, data = mail.uid("FETCH", ",".join(batch), items)
+            if status != "OK":
+                print(f"Error fetching emails {','.join(batch)}: {data}")
+                failed.update(map(int, batch))
+                continue
+            size += sum(len(item[1]) for item in data if isinstance(item, tuple))
+            for parts in parse_fetch(data):
+                header = parts.get(b"HEADER.FIELDS", b"").rstrip(b"\r\n")
+                if section == "TEXT":
+                    message = header + b"\r\n\r\n" + parts.get(b"TEXT", b"")
+                else:
+                    # the part is decoded with its own MIME headers
+                    message = (header + b"\r\n" if header else b"") + parts.get(
+                        f"{section}.MIME".encode(), b"\r\n") + parts.get(section.encode(), b"")
+                messages.append((int(parts["uid"]), email.message_from_bytes(message)))
+        m.bytes_out = size
+    return sorted(messages, key=lambda message: message[0]), failed
 
 
-def find_urls_in_text(text):
-    """Finds potential URLs within a text string using regex."""
-    url_pattern = re.compile(
-        r"https?://[^\s<>\[\]\"\']+"
-    )
-    potential_urls = url_pattern.findall(text)
-    valid_urls = [url for url in potential_urls if is_valid_url(url)]
-    return valid_urls
+def scan_batch(mail, executor, downloader, uids, sync):
+    """Fetches a batch of emails and queues the downloads of their URLs.
 
+    Returns a dict with the batch "uids", the uids to flag when the
+    downloads finish ("flagged") and the "pending" download futures mapped
+    to the uid of their email. The first uid that couldn't be fetched goes
+    to sync["failed"].
+    """
+    batch = {"uids": uids, "flagged": [], "pending": {}}
+    messages, failed = fetch_messages(mail, uids)
+    if failed:
+        sync["failed"] = min(failed if sync["failed"] is None else failed | {sync["failed"]})
+    for uid, msg in messages:
+        body = get_text_body(msg)
+        if not body:
+            continue
+        urls = find_urls_in_text(body)
+        if urls:
+            print(f"--- URLs found in email UID {uid} from {msg['From']} ---")
+        for url in urls:
+            if is_listing(url):
+                future = executor.submit(fetch_and_filter_urls, downloader, url, True, False)
+                batch["pending"][future] = uid
+        batch["flagged"].append(uid)
+    return batch
 
-def find_urls_in_text_javascript(text):
-    """Finds javascript:self.abre(*) URLs within a text string using regex."""
-    url_pattern = re.compile(r"javascript:self.abre\('(.+)'\)")
-    potential_urls = url_pattern.findall(text)
-    valid_urls = [url for url in potential_urls if is_valid_url(url)]
-    return valid_urls
+
+def finish_batch(mail, executor, downloader, batch, sync):
+    """Waits for the downloads of a batch, following listing pages to their
+    PDFs, then marks the batch emails as PROCESSED."""
+    from concurrent.futures import FIRST_COMPLETED, wait
+    pending = batch["pending"]
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            uid = pending.pop(future)
+            for url in future.result() or []:
+                pdf = executor.submit(fetch_and_filter_urls, downloader, url, False, False)
+                pending[pdf] = uid
+    mark_processed(mail, batch, sync)
 
 
 def fetch_and_scan_emails():
     """Connects to the IMAP server, fetches emails from the specified sender,
-    scans the body for URLs, and prints them to the console."""
+    scans the body for URLs, and prints them to the console.
+
+    Only emails above the imap_sync checkpoint of the mailbox are searched.
+    They are fetched FETCH_BATCH at a time while the downloads of the
+    previous batch run on DOWNLOAD_WORKERS threads sharing one Downloader,
+    or through the stages of scan_async with --async. The downloads that
+    failed in previous scans are retried first."""
+    import imaplib
     try:
         mail = imaplib.IMAP4_SSL(IMAP_SERVER)
         mail.login(EMAIL_ADDRESS, PASSWORD)
+        if "CONDSTORE" in mail.capabilities and "ENABLE" in mail.capabilities:
+            # the server then sends HIGHESTMODSEQ on SELECT
+            mail.enable("CONDSTORE")
         result = mail.select(MAILBOX)
         if result[0] != 'OK':
             mail.logout()
             print (result[1])
             return -1
-        session = requests.Session()
         create_cache_table()
+        sync = get_sync_state(mail)
+        uids = search_uids(mail, sync)
+        retries = due_retries()
 
-        search_criteria = [f'FROM "{SENDER_DOMAIN}"', "UNKEYWORD", "PROCESSED"]
-
-        # Add SINCE criteria if a date is configured
-        if DATE_FILTER_SINCE:
-            search_criteria.append("SINCE")
-            search_criteria.append(DATE_FILTER_SINCE)
-
-        status, email_ids = mail.search(
-            None, *search_criteria
-        )
-        
-        if status == "OK":
-            for email_id in email_ids[0].split():
-                body = None
-                status, msg_data = mail.fetch(email_id, "(RFC822)")
-                if status == "OK":
-                    msg = email.message_from_bytes(msg_data[0][1])
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            ctype = part.get_content_type()
-                            cdispo = str(part.get("Content-Disposition"))
-
-                            # Look for plain text parts and ignore attachments/HTML
-                            if ctype == "text/plain" and "attachment" not in cdispo:
-                                body = part.get_payload(decode=True).decode(
-                                    errors="ignore"
-                                )
-                    else:
-                        body = msg.get_payload(decode=True).decode(errors="ignore")
-                    if body:
-                        urls = find_urls_in_text(body)
-                        if urls:
-                            print(
-                                f"--- URLs found in email ID {email_id.decode()} from {msg['From']} ---"
-                            )
-                            for url in urls:
-                                if url.startswith("https://l.triunfonet.com.ar"):
-                                    fetch_and_filter_urls(session, url)
-                            print("-" * 60)
-                        mail.store(email_id, "+FLAGS", ("PROCESSED",))
-                else:
-                    print(f"Error fetching email {email_id.decode()}: {msg_data}")
-        else:
-            print(f"Error searching emails: {status}")
+        if (uids or retries) and SCAN_ASYNC:
+            scan_async(mail, sync, uids or [], retries)
+        elif uids or retries:
+            # an empty scan never loads requests
+            from concurrent.futures import ThreadPoolExecutor
+            downloader = Downloader(DOWNLOAD_WORKERS)
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                if retries:
+                    retry_downloads(executor, downloader, retries)
+                previous = None
+                for i in range(0, len(uids or []), FETCH_BATCH):
+                    # fetch the next batch while the previous one downloads
+                    batch = scan_batch(mail, executor, downloader, uids[i:i + FETCH_BATCH], sync)
+                    if previous is not None:
+                        finish_batch(mail, executor, downloader, previous, sync)
+                    previous = batch
+                if previous is not None:
+                    finish_batch(mail, executor, downloader, previous, sync)
+            downloader.close()
+        if uids is not None:
+            # every email below UIDNEXT was considered, unless one failed
+            if sync["uidnext"] and sync["failed"] is None:
+                sync["last_uid"] = max(sync["last_uid"], sync["uidnext"] - 1)
+            if sync["stored"]:
+                # our STORE changed the mailbox, HIGHESTMODSEQ moved
+                sync["highestmodseq"] = None
+            save_checkpoint(sync)
+            get_storage().commit()
 
         mail.logout()
-        session.close()
 
     except Exception as e:
         # print(f"An error occurred: {e}")
         raise
 
-def get_name_poliza(doc, excel=False):
-    """Parses a fitz PDF doc and extracts some important info"""
-    folder = "pólizas"
-    # name
-    page = doc[0]
-    h = page.rect.height
-    num_fac = page.get_text("text", clip=(114, h - 668, 182, h - 654)).strip()
-    patente = page.get_text("text", clip=(439, h - 510, 501, h - 491)).strip()
-    suplemento = page.get_text(
-        "text", clip=(170, h - 631, 203, h - 619)
-    ).strip()
-    fecha = re.findall(
-        r"\d+", page.get_text("text", clip=((148.67, 250.00, 215.33, 270.67)))
+class Pipeline:
+    """Counts the items in the stages of scan_async, in total and per email"""
+
+    def __init__(self):
+        import asyncio
+        self.pending = 0
+        self.emails = {}  # uid -> items of the email in the stages
+        self.finished = []  # uids whose items all left the stages, in no order
+        self.idle = asyncio.Event()
+
+    def add(self, uid):
+        self.pending += 1
+        self.idle.clear()
+        if uid is not None:
+            self.emails[uid] = self.emails.get(uid, 0) + 1
+
+    def remove(self, uid):
+        self.pending -= 1
+        if uid is not None:
+            self.emails[uid] -= 1
+            if not self.emails[uid]:
+                del self.emails[uid]
+                self.finished.append(uid)
+        if not self.pending:
+            self.idle.set()
+
+
+class Stage:
+    """A stage of scan_async: concurrency workers running handler on the
+    items of a queue.
+
+    The previous stage puts items with put, which waits while queue_size
+    items are waiting, so a slow stage holds back the ones before it. A
+    later stage sends items back with feed, which never waits, so the cycle
+    between the urls and download stages can't deadlock. Every item is a
+    tuple starting with the uid of its email, or None.
+    """
+
+    def __init__(self, pipeline, name, handler, concurrency, queue_size):
+        import asyncio
+        self.pipeline = pipeline
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(queue_size) if queue_size else None
+        self.items = 0
+        self.seconds = 0.0  # handler time of the workers
+        self.blocked = 0.0  # part of it waiting to put items in the next stages
+
+    async def put(self, item, source):
+        """Queues an item of the source stage, waiting for room"""
+        if self.slots:
+            start = time.perf_counter()
+            await self.slots.acquire()
+            source.blocked += time.perf_counter() - start
+        self.pipeline.add(item[0])
+        self.queue.put_nowait((item, True))
+
+    def feed(self, item):
+        """Queues an item without waiting"""
+        self.pipeline.add(item[0])
+        self.queue.put_nowait((item, False))
+
+    async def work(self):
+        while True:
+            item, slot = await self.queue.get()
+            if slot and self.slots:
+                self.slots.release()
+            start = time.perf_counter()
+            await self.handler(item)
+            self.seconds += time.perf_counter() - start
+            self.items += 1
+            self.pipeline.remove(item[0])
+
+    def report(self, seconds):
+        """Prints the items and the share of the workers' time handling them
+        (busy) and waiting for the next stages (blocked)"""
+        capacity = seconds * self.concurrency or 1
+        print(f"{self.name:<10}{self.concurrency:>8}{self.queue_size or '-':>7}{self.items:>8}"
+              f"{(self.seconds - self.blocked) / capacity:>8.1%}{self.blocked / capacity:>9.1%}")
+
+
+def prepare_worker(partition, url, urltype, content):
+    """prepare_pdf in a --async worker for the partition the parent chose,
+    also returns the stages measured for --stats"""
+    return prepare_pdf(get_partition(partition), url, urltype, content), take_stats()
+
+
+def scan_async(mail, sync, uids, retries):
+    """Scans the emails as a pipeline of SCAN_STAGES connected by queues:
+
+    imap      fetches the emails FETCH_BATCH at a time
+    urls      finds the listing URLs in the emails and the PDF URLs in the
+              listing pages
+    download  downloads them with a Downloader in threads
+    prepare   expands, parses and diffs the PDFs in worker processes
+    write     saves them, then flags the finished emails and moves the
+              checkpoint FETCH_BATCH emails at a time
+
+    so the IMAP round trips, the downloads and the PyMuPDF work overlap.
+    Prints the utilization of each stage at the end.
+    """
+    import asyncio
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor
+    # only this process creates partitions, the workers open them
+    write_partition()
+    # workers open their own connection, never share it across a fork
+    commit_storage()
+    export_templates()
+    close_storage()
+    jobs = SCAN_STAGES["prepare"][0]
+    processes = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                    initargs=(global_stats is not None,))
+    # fork the workers before any thread starts
+    processes.submit(os.getpid).result()
+    downloader = Downloader(SCAN_STAGES["download"][0])
+    imap_lock = threading.Lock()
+    scanned = set()  # emails with a text body, flagged when finished
+    checkpoint = iter(uids)  # the uids not yet covered by the checkpoint
+    finished = set()
+    next_uid = next(checkpoint, None)
+
+    async def run(function, *args, executor=None):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    def fetch(batch):
+        with imap_lock:
+            return fetch_messages(mail, batch)
+
+    async def read(item):
+        batch = item[1]
+        messages, failed = await run(fetch, batch, executor=threads)
+        if failed:
+            # never finished, flush keeps the checkpoint below them
+            sync["failed"] = min(failed if sync["failed"] is None else failed | {sync["failed"]})
+        for uid, msg in messages:
+            await stages["urls"].put((uid, "email", msg), stages["imap"])
+        # emails deleted since the search are done
+        pipeline.finished += set(batch) - {uid for uid, _ in messages} - failed
+
+    async def find(item):
+        uid, kind, *rest = item
+        if kind == "email":
+            msg = rest[0]
+            body = get_text_body(msg)
+            if not body:
+                return
+            scanned.add(uid)
+            urls = find_urls_in_text(body)
+            if urls:
+                print(f"--- URLs found in email UID {uid} from {msg['From']} ---")
+            for url in urls:
+                if is_listing(url):
+                    await stages["download"].put((uid, url, False), stages["urls"])
+        else:
+            url, content = rest
+            found = find_urls_in_text_javascript(content.decode())
+            if found:
+                # we save a JSON array of PDF URLs
+                await stages["write"].put((uid, "listing", url, found), stages["urls"])
+            for pdf in found:
+                await stages["download"].put((uid, pdf, False), stages["urls"])
+
+    async def download(item):
+        uid, url, retry = item
+        done = True
+        if is_listing(url):
+            found = await run(get_cached_content, url, executor=threads)
+            if found:
+                print(f"Using cached content for '{url}'")
+                for pdf in found:
+                    stages["download"].feed((uid, pdf, False))
+            else:
+                content = await run(fetch_url, downloader, url, executor=threads)
+                done = content is not None
+                if done:
+                    stages["urls"].feed((uid, "listing", url, content))
+        elif not re.search(REGEX_PDFURL, url):
+            pass  # we don't save other kinds of url
+        elif await run(storage_has, url, executor=threads):
+            print(f"Using cached content for '{url}'")
+        else:
+            content = await run(fetch_url, downloader, url, executor=threads)
+            done = content is not None
+            if done:
+                await stages["prepare"].put((uid, url, content), stages["download"])
+        if retry and done:
+            await run(get_storage().write, "DELETE FROM download_retries WHERE url = ?", (url,),
+                      executor=writer)
+
+    async def prepare(item):
+        uid, url, content = item
+        urltype = re.search(REGEX_PDFURL, url)[1]
+        partition = write_partition().name
+        row, stages_measured = await run(prepare_worker, partition, url, urltype, content,
+                                         executor=processes)
+        if stages_measured:
+            global_stats.merge(stages_measured)
+        if row:
+            await stages["write"].put((uid, "pdf", partition, urltype, row), stages["prepare"])
+
+    def save(kind, *args):
+        if kind == "listing":
+            cache_content(*args)
+        else:
+            partition, urltype, row = args
+            # the partition its bases were chosen from
+            with pdf_lock:
+                save_pdf(get_partition(partition), urltype, row)
+
+    async def write(item):
+        await run(save, *item[1:], executor=writer)
+        if len(pipeline.finished) >= FETCH_BATCH:
+            await flush()
+
+    def mark(batch):
+        with imap_lock:
+            mark_processed(mail, batch, sync)
+
+    async def flush():
+        """Flags the finished emails and moves the checkpoint to the last uid
+        with every uid before it finished"""
+        nonlocal next_uid
+        finished.update(pipeline.finished)
+        batch = {"uids": [], "flagged": [uid for uid in pipeline.finished if uid in scanned]}
+        pipeline.finished.clear()
+        while next_uid is not None and next_uid in finished:
+            batch["uids"].append(next_uid)
+            next_uid = next(checkpoint, None)
+        await run(mark, batch, executor=writer)
+
+    async def scan():
+        nonlocal pipeline, stages
+        pipeline = Pipeline()
+        handlers = {"imap": read, "urls": find, "download": download,
+                    "prepare": prepare, "write": write}
+        stages = {
+            name: Stage(pipeline, name, handlers[name], *SCAN_STAGES[name])
+            for name in handlers
+        }
+        if retries:
+            print(f"Retrying {len(retries)} failed downloads")
+        for url in retries:
+            stages["download"].feed((None, url, True))
+        for i in range(0, len(uids), FETCH_BATCH):
+            stages["imap"].feed((None, uids[i:i + FETCH_BATCH]))
+        start = time.perf_counter()
+        workers = [
+            asyncio.create_task(stage.work())
+            for stage in stages.values() for _ in range(stage.concurrency)
+        ]
+        idle = asyncio.create_task(pipeline.idle.wait())
+        done, _ = await asyncio.wait([idle, *workers], return_when=FIRST_COMPLETED)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for task in done:
+            # a worker only ends with an error
+            task.result()
+        await flush()
+        seconds = time.perf_counter() - start
+        print(f"{'stage':<10}{'workers':>8}{'queue':>7}{'items':>8}{'busy':>8}{'blocked':>9}")
+        for stage in stages.values():
+            stage.report(seconds)
+
+    pipeline = stages = None
+    threads = ThreadPoolExecutor(max_workers=SCAN_STAGES["download"][0] + 1)
+    writer = ThreadPoolExecutor(max_workers=1)
+    try:
+        asyncio.run(scan())
+    finally:
+        threads.shutdown()
+        writer.shutdown()
+        processes.shutdown()
+        downloader.close()
+    commit_storage()
+
+
+def parse_digits(text):
+    return re.findall(r"\d+", text)
+
+
+def parse_amount(text):
+    return safefloat(text, thousands_sep=".")
+
+
+# Fields of each document type on its first page: name -> (clip, parser).
+# Clips are (x0, y0, x1, y1) in points, a negative y is measured from the
+# bottom of the page.
+POLIZA_FIELDS = {
+    "num_fac": ((114, -668, 182, -654), str.strip),
+    "patente": ((439, -510, 501, -491), str.strip),
+    "suplemento": ((170, -631, 203, -619), str.strip),
+    "fecha": ((148.67, 250.00, 215.33, 270.67), parse_digits),
+    "premio": ((134, 520, 190, 534), parse_amount),
+    "prima": ((122, 415, 207, 424), parse_amount),
+    "iva": ((122, 424, 207, 434), parse_amount),
+    "af": ((162, 434, 204, 441), parse_amount),
+    "iva_af": ((122, 444, 207, 450), parse_amount),
+    "sellos": ((122, 451, 206, 460), parse_amount),
+    "otros_imp": ((122, 469, 206, 478), parse_amount),
+    "otros_grv": ((122, 479, 206, 487), parse_amount),
+    "cuotas_soc": ((122, 487, 206, 496), parse_amount),
+}
+TARJETACIR_FIELDS = {
+    "patente": ((112, -151, 234, -134), str.strip),
+    "fecha": ((228, -243, 327, -224), parse_digits),
+}
+TARJETAVER_FIELDS = {
+    "patente": ((64, -303, 181, -291), str.strip),
+    "fecha": ((146, -354, 223, -342), parse_digits),
+}
+# The document types get_metadata parses, by a marker of their url: the
+# folder they are extracted to, the layout table of their fields, the number
+# of dates in their "fecha" field (day, month, year each), whether the day
+# and month are padded to two digits, the name of their file (a format of
+# the metadata and of the desde and hasta [year, month, day] lists) and the
+# fields converted after the name is made.
+DOCUMENT_TYPES = {
+    "hpoliza": {
+        "folder": "pólizas",
+        "fields": POLIZA_FIELDS,
+        "dates": 2,
+        "pad_dates": False,
+        "name": "{desde[0]}-{desde[1]}@{hasta[0]}-{hasta[1]}_{num_fac}_{suplemento}_{patente}",
+        "convert": {"num_fac": parse_amount},
+    },
+    "tarjetacir": {
+        "folder": "tarjetas_circulación",
+        "fields": TARJETACIR_FIELDS,
+        "dates": 1,
+        "pad_dates": False,
+        "name": "{fecha_desde}_{patente}",
+    },
+    "tarjetaver": {
+        "folder": "tarjetas_verdes",
+        "fields": TARJETAVER_FIELDS,
+        "dates": 1,
+        "pad_dates": True,
+        "name": "{fecha_desde}_{patente}",
+    },
+}
+
+
+class PageText:
+    """The words of a page, read once, answering the text of clip rectangles.
+
+    page.get_text("text", clip=...) parses the whole page on every call.
+    Here the words are read once, sorted by their top, and a clip only looks
+    at the words in its band of the page. A word inside the clip is taken
+    whole and a word outside is skipped; get_text decides by the ink of each
+    glyph, so a word cut by a side of the clip falls back to get_text.
+    """
+
+    def __init__(self, page):
+        import fitz
+        self.page = page
+        self.height = page.rect.height
+        # boxes of the glyphs ink, not of the font, as get_text clips by
+        words = page.get_text("words", flags=fitz.TEXTFLAGS_WORDS | fitz.TEXT_ACCURATE_BBOXES)
+        self.words = sorted(words, key=lambda word: word[1])
+        self.tops = [word[1] for word in self.words]
+        self.max_height = max((word[3] - word[1] for word in self.words), default=0)
+
+    def text(self, clip):
+        x0, y0, x1, y1 = clip
+        # only a word with top above y1 and bottom below y0 can overlap the clip
+        start = bisect.bisect_left(self.tops, y0 - self.max_height)
+        end = bisect.bisect_left(self.tops, y1)
+        lines = {}
+        for wx0, wy0, wx1, wy1, word, block, line, number in self.words[start:end]:
+            if wy1 <= y0 or wx1 <= x0 or wx0 >= x1:
+                continue
+            if wx0 < x0 or wx1 > x1 or wy0 < y0 or wy1 > y1:
+                return self.page.get_text("text", clip=clip)
+            lines.setdefault((block, line), []).append((number, word))
+        return "\n".join(
+            " ".join(word for _, word in sorted(words))
+            for _, words in sorted(lines.items())
+        )
+
+
+def page_clip(clip, height):
+    """Resolves the negative y of a layout clip from the bottom of a page of height"""
+    x0, y0, x1, y1 = clip
+    return (x0, height + y0 if y0 < 0 else y0, x1, height + y1 if y1 < 0 else y1)
+
+
+def extract_fields(page, fields):
+    """Returns the parsed value of every field of a layout table, see POLIZA_FIELDS"""
+    page_text = PageText(page)
+    return {
+        name: parse(page_text.text(page_clip(clip, page_text.height)))
+        for name, (clip, parse) in fields.items()
+    }
+
+
+def get_metadata(url, doc):
+    """Parses a fitz PDF doc and returns the poliza_metadata values of the url,
+    with the DOCUMENT_TYPES entry its url matches. Raises IndexError or
+    ValueError if the fields aren't where its layout says."""
+    metadata = dict.fromkeys(METADATA_FIELDS)
+    kind = next((kind for marker, kind in DOCUMENT_TYPES.items() if marker in url), None)
+    if kind is None:
+        metadata["folder"] = "otros"
+        metadata["name"] = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return metadata
+    fields = extract_fields(doc[0], kind["fields"])
+    fecha = fields.pop("fecha")
+    if len(fecha) < 3 * kind["dates"]:
+        raise IndexError(f"Expected {kind['dates']} dates in fecha {fecha}")
+    # day, month, year -> [year, month, day]
+    dates = [fecha[i:i + 3][::-1] for i in range(0, 3 * kind["dates"], 3)]
+    if kind["pad_dates"]:
+        dates = [[year, month.zfill(2), day.zfill(2)] for year, month, day in dates]
+    desde, hasta = (dates + [None])[:2]
+    metadata.update(
+        (field, value) for field, value in fields.items() if field in metadata
     )
-    name = "_".join([f'{fecha[2]}-{fecha[1]}@{fecha[5]}-{fecha[4]}',
-                     num_fac, suplemento, patente])
-    if not excel:
-        return folder, name
-        
-    # excel
-    num_fac = safefloat(num_fac, thousands_sep=".")
-    
-    premio = page.get_text(
-        "text", clip=(134, 520, 190, 534)
-    ).strip()
-    premio = safefloat(premio, thousands_sep=".")
-    
-    prima = page.get_text(
-        "text", clip=(122, 415, 207, 424)
-    ).strip()
-    prima = safefloat(prima, thousands_sep=".")
-    
-    iva = page.get_text(
-        "text", clip=(122, 424, 207, 434)
-    ).strip()
-    iva = safefloat(iva, thousands_sep=".")
-    
-    af = page.get_text(
-        "text", clip=(162, 434, 204, 441)
-    ).strip()
-    af = safefloat(af, thousands_sep=".")
-    
-    iva_af = page.get_text(
-        "text", clip=(122, 444, 207, 450)
-    ).strip()
-    iva_af = safefloat(iva_af, thousands_sep=".")
-
-    sellos = page.get_text(
-        "text", clip=(122, 451, 206, 460)
-    ).strip()
-    sellos = safefloat(sellos, thousands_sep=".")
-    
-    otros_imp = page.get_text(
-        "text", clip=(122, 469, 206, 478)
-    ).strip()
-    otros_imp = safefloat(otros_imp, thousands_sep=".")
-    
-    otros_grv = page.get_text(
-        "text", clip=(122, 479, 206, 487)
-    ).strip()
-    otros_grv = safefloat(otros_grv, thousands_sep=".")
-    
-    cuotas_soc = page.get_text(
-        "text", clip=(122, 487, 206, 496)
-    ).strip()
-    cuotas_soc = safefloat(cuotas_soc, thousands_sep=".")
-    
-    return (fecha, num_fac, suplemento, patente, premio, prima, iva, af,
-            iva_af, sellos, otros_imp, otros_grv, cuotas_soc)
-            
-def file_save(name, content):
+    metadata.update(
+        folder=kind["folder"],
+        fecha_desde="-".join(desde),
+        fecha_hasta="-".join(hasta) if hasta else None,
+    )
+    metadata["name"] = kind["name"].format(desde=desde, hasta=hasta, **metadata)
+    for field, convert in kind.get("convert", {}).items():
+        metadata[field] = convert(metadata[field])
+    # safefloat returns '' for empty fields, we store them as NULL
+    return {k: None if v == '' else v for k, v in metadata.items()}
+
+
+def save_metadata(storage, url, metadata):
+    """Stores the poliza_metadata row of a url"""
+    storage.write(INSERT_METADATA, (url, *(metadata[f] for f in METADATA_FIELDS)))
+
+
+def load_metadata(url):
+    """Retrieves the poliza_metadata row of a url as a dict, or None"""
+    result = find_row(SELECT_METADATA, (url,))[1]
+    # an unparseable PDF has a row of NULLs, see backfill_metadata
+    if result is None or result[METADATA_FIELDS.index("name")] is None:
+        return None
+    return dict(zip(METADATA_FIELDS, result))
+
+
+def backfill_metadata():
+    """Fill poliza_metadata for PDFs cached before the table existed. A PDF
+    that can't be parsed gets a row of NULLs, so it is only tried once."""
+    import fitz
+    create_cache_table()
+    indexed = 0
+    for storage in get_partitions():
+        cursor = storage.query(
+            "SELECT f.url FROM fetched_content f LEFT JOIN poliza_metadata m ON m.url = f.url "
+            f"WHERE {url_range(PDF_URL, 'f.url')} AND m.url IS NULL order by f.rowid"
+        )
+        urls = [result[0] for result in cursor.fetchall()]
+        if urls and storage.frozen:
+            print(f"Skipping {len(urls)} documents of the frozen partition {storage.name}")
+            continue
+        if urls and not indexed:
+            # before the first partition with documents to index
+            export_templates()
+            load_templates()
+        for number, url in enumerate(urls, 1):
+            content = get_cached_content(url)
+            if not content:
+                print("No content at URL:" + url)
+                continue
+            doc = fitz.open(stream=content, filetype="pdf")
+            try:
+                metadata = get_metadata(url, doc)
+            except (IndexError, ValueError) as e:
+                print(f"Error parsing '{url}': {e}")
+                metadata = dict.fromkeys(METADATA_FIELDS)
+            finally:
+                doc.close()
+            save_metadata(storage, url, metadata)
+            if number % 100 == 0:
+                print(f"Indexed {number}/{len(urls)} documents")
+        storage.commit()
+        indexed += len(urls)
+    if indexed:
+        get_pdf_cache().report()
+    return indexed
+
+
+def file_save(name, content, overwrite=False):
+    if overwrite:
+        # replace a stale output atomically, readers never see half a file
+        temp = name + ".tmp"
+        with open(temp, "wb") as filew:
+            filew.write(content)
+        os.replace(temp, name)
+        return
     if os.path.exists(name):
         return
-    with open(name, "wb") as filew:
-        filew.write(content)
+    try:
+        # exclusive create, so parallel workers never overwrite each other
+        with open(name, "xb") as filew:
+            filew.write(content)
+    except FileExistsError:
+        pass
 
-def extract_file(url, return_bytes=False, excel=False):
-    """Save a file from a url or return the bytes of the file or return Excel data"""
-    doc = None
+def extract_file(url, return_bytes=False, overwrite=False):
+    """Save a file from a url and return its path, or return the name and bytes of the file"""
+    import fitz
     content = get_cached_content(url)
     if not content:
         print("No content at URL:" + url)
         return None, None
-    doc = fitz.open(stream=content, filetype="pdf")
-    if not doc:
-        print("Error on fitz.open at URL:" + url)
-        return None, None
-    if "hpoliza" in url:
-        if not excel:
-            folder, name = get_name_poliza(doc)
-        else:
-            datos = get_name_poliza(doc, excel)
-            doc.close()
-            return datos
-    elif "tarjetacir" in url:
-        folder = "tarjetas_circulación"
-        # name
-        page = doc[0]
-        h = page.rect.height
-        patente = page.get_text("text", clip=(112, h - 151, 234, h - 134)).strip()
-        fecha = re.findall(
-            r"\d+", page.get_text("text", clip=(228, h - 243, 327, h - 224))
-        )
-        fecha.reverse()
-        name = "_".join(("-".join(fecha), patente))
-    elif "tarjetaver" in url:
-        folder = "tarjetas_verdes"
-        # name
-        page = doc[0]
-        h = page.rect.height
-        patente = page.get_text("text", clip=(64, h - 303, 181, h - 291)).strip()
-        fecha = re.findall(
-            r"\d+", page.get_text("text", clip=(146, h - 354, 223, h - 342))
-        )
-        fecha.reverse()
-        fecha[1] = fecha[1].zfill(2)
-        fecha[2] = fecha[2].zfill(2)
-        name = "_".join(("-".join(fecha), patente))
-    else:
-        folder = "otros"
-        name = str(number)
+    metadata = load_metadata(url)
+    if metadata is None:
+        # not indexed yet (see --backfill), we parse the PDF
+        doc = fitz.open(stream=content, filetype="pdf")
+        metadata = get_metadata(url, doc)
+        doc.close()
+    folder, name = metadata["folder"], metadata["name"]
+    if return_bytes:
+        return name, content
     path = Path("extracted_pdfs").joinpath(folder)
-    if not return_bytes:
-        path.mkdir(parents=True, exist_ok=True)
-    #if doc: (doc is not None here)
+    path.mkdir(parents=True, exist_ok=True)
     fullname = path.joinpath(name + ".pdf").as_posix()
-    if not return_bytes:
-        file_save(fullname, content)
-    else:
-        return name, content
-    doc.close()
+    with measure("file.write", len(content)):
+        file_save(fullname, content, overwrite)
+    return fullname
 
 
-def extract_files():
-    """Extract cached PDFs to folder"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT url FROM fetched_content WHERE url LIKE 'https://www.triunfonet.com.ar/gauswebtriunfo/servlet/%' order by rowid"
+def file_sha256(path):
+    """SHA-256 of a file on disk, or None if it does not exist"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as filer:
+            for block in iter(lambda: filer.read(1 << 20), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def record_extraction(storage, url, path):
+    """Stores in extraction_manifest the file written for url as it is on disk"""
+    stat = os.stat(path)
+    storage.write(
+        "INSERT OR REPLACE INTO extraction_manifest (url, path, sha256, size, mtime, extract_time) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (url, path, file_sha256(path), stat.st_size, stat.st_mtime, time.time()),
     )
-    number = 0
 
-    while True:
-        result = cursor.fetchone()
-        if result is None:
-            break
-        extract_file(result[0])
-    conn.close()
+
+def output_changed(path, sha256, size, mtime):
+    """Whether an extracted file is missing or differs from its manifest entry"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return True
+    if stat.st_size == size and stat.st_mtime == mtime:
+        return False
+    # touched or copied over, only a different content counts
+    return file_sha256(path) != sha256
+
+
+def pending_extractions():
+    """Returns (url, overwrite) of the rows whose output file is not up to date.
+
+    Rows without a manifest entry were added since the last --extract, their
+    file is not overwritten if it already exists (i.e. extracted before the
+    manifest existed). Rows whose file is missing or changed are rebuilt.
+    """
+    rows = []
+    for storage in get_partitions():
+        # the manifest is in the main file, the partition is attached to join it
+        rows += query_attached(
+            storage,
+            "SELECT f.url, m.path, m.sha256, m.size, m.mtime FROM {part}.fetched_content f "
+            "LEFT JOIN main.extraction_manifest m ON m.url = f.url "
+            f"WHERE {url_range(PDF_URL, 'f.url')} order by f.rowid",
+        )
+    pending = []
+    for url, path, sha256, size, mtime in rows:
+        if path is None:
+            pending.append((url, False))
+        elif output_changed(path, sha256, size, mtime):
+            pending.append((url, True))
+    return pending
+
+
+def verify_extraction():
+    """Checks the extracted files against the manifest without rebuilding them.
+
+    Returns the number of rows that are not extracted or whose file is
+    missing or changed.
+    """
+    create_cache_table()
+    rows = []
+    for storage in get_partitions():
+        rows += query_attached(
+            storage,
+            "SELECT f.url, m.path, m.sha256 FROM {part}.fetched_content f "
+            "LEFT JOIN main.extraction_manifest m ON m.url = f.url "
+            f"WHERE {url_range(PDF_URL, 'f.url')} order by f.rowid",
+        )
+    verified = not_extracted = missing = changed = 0
+    for url, path, sha256 in rows:
+        if path is None:
+            not_extracted += 1
+            continue
+        actual = file_sha256(path)
+        if actual is None:
+            missing += 1
+            print("Missing: " + path)
+        elif actual != sha256:
+            changed += 1
+            print("Changed: " + path)
+        else:
+            verified += 1
+    print(
+        f"{verified} files verified, {missing} missing, {changed} changed, "
+        f"{not_extracted} documents not extracted"
+    )
+    return not_extracted + missing + changed
+
+
+def list_templates(storage):
+    """Returns the [key, creation time, table, rowid, codec, dict_id] of the
+    templates and bases of a partition, without reading them"""
+    # templates are stored with the servlet name (urltype) as url
+    return [list(row) for row in storage.fetchall(
+        "SELECT url, fetch_time, 'fetched_content', rowid, codec, dict_id FROM fetched_content "
+        f"WHERE {TEMPLATE_URLS} "
+        "UNION ALL SELECT id, create_time, 'delta_bases', id, codec, NULL FROM delta_bases"
+    )]
+
+
+def read_templates_file(storage):
+    """Maps the templates sidecar of a partition read-only, returns the map and
+    its index of [key, creation time, offset, size], or (None, None) if it is
+    missing or its templates are not the ones of the partition"""
+    import mmap
+    try:
+        with open(storage.filename + TEMPLATES_SUFFIX, "rb") as filer:
+            mapped = mmap.mmap(filer.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None, None
+    # the index is at the end, followed by its size
+    size = int.from_bytes(mapped[-8:], "little")
+    index = json.loads(mapped[-8 - size:-8])
+    if {tuple(entry[:2]) for entry in index} != {tuple(entry[:2]) for entry in list_templates(storage)}:
+        mapped.close()
+        return None, None
+    return mapped, index
+
+
+def export_templates():
+    """Writes the templates sidecar of every partition whose templates changed,
+    before starting workers that call load_templates.
+
+    The sidecar next to each db file has every template and base expanded,
+    so the workers map it instead of decoding their own copy of each one.
+    """
+    for storage in get_partitions():
+        mapped, _ = read_templates_file(storage)
+        if mapped is not None:
+            mapped.close()
+            continue
+        path = storage.filename + TEMPLATES_SUFFIX
+        temporary = f"{path}.{os.getpid()}"
+        index = []
+        with open(temporary, "wb") as filew:
+            for key, created, table, rowid, codec, dict_id in list_templates(storage):
+                offset = filew.tell()
+                with open_blob(storage, table, rowid) as blob:
+                    size = copy_blob(storage, blob, codec, filew, dict_id)
+                index.append([key, created, offset, size])
+            data = json.dumps(index).encode()
+            filew.write(data + len(data).to_bytes(8, "little"))
+        # workers that mapped the old file keep reading it
+        os.replace(temporary, path)
+
+
+def load_templates():
+    """Maps the templates of every partition from the sidecars of
+    export_templates, used as the initializer of --jobs workers.
+
+    The pages are shared by every process mapping the file, a template not
+    in its sidecar is read from the db by get_base.
+    """
+    for storage in get_partitions():
+        mapped, index = read_templates_file(storage)
+        if mapped is None:
+            continue
+        view = memoryview(mapped)
+        for key, _, offset, size in index:
+            storage.templates[key] = view[offset:offset + size]
+
+
+def init_worker(stats):
+    """Initializer of the --jobs workers, stats is whether --stats is on"""
+    if stats:
+        enable_stats()
+    load_templates()
+
+
+def extract_task(task):
+    """Extracts a file in a --jobs worker, returns its path, the worker cache
+    stats and the stages measured for --stats"""
+    url, overwrite = task
+    path = extract_file(url, overwrite=overwrite)
+    return url, path, os.getpid(), dict(get_pdf_cache().stats), take_stats()
 
 
-def ingest(files):
-    "Add old pólizas to db"
+def extract_files(jobs=1):
+    """Extract to folder the cached PDFs that are new or changed, using jobs worker processes
+
+    Every file written is recorded in extraction_manifest, so the next run
+    only rebuilds the rows added since or whose file is missing or changed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    create_cache_table()
+    pending = pending_extractions()
+    print(f"{len(pending)} documents to extract")
+    if pending:
+        # the workers, or this process, map the bases instead of decoding them
+        export_templates()
+    if jobs > 1:
+        # workers open their own connection, never share it across a fork
+        close_storage()
+        workers = {}
+        extracted = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(global_stats is not None,)) as executor:
+            # consume the results so worker exceptions are raised here
+            for url, path, pid, stats, stages in executor.map(extract_task, pending, chunksize=8):
+                workers[pid] = stats
+                if stages:
+                    global_stats.merge(stages)
+                if isinstance(path, str):
+                    extracted.append((url, path))
+        # the parent is the only writer, once every worker is gone
+        storage = get_storage()
+        for url, path in extracted:
+            record_extraction(storage, url, path)
+        storage.commit()
+        get_pdf_cache().report({
+            key: sum(stats[key] for stats in workers.values())
+            for key in ("memory_hits", "disk_hits", "misses")
+        })
+        return
+
+    storage = get_storage()
+    load_templates()
+    for url, overwrite in pending:
+        path = extract_file(url, overwrite=overwrite)
+        if isinstance(path, str):
+            record_extraction(storage, url, path)
+    storage.commit()
+    get_pdf_cache().report()
+
+
+def walk_pdfs(files):
+    """Yields the PDF files in a list of files and directories, lazily"""
     for file in files:
-        if os.path.isdir(file):
-            pdf_files = [f for f in Path(file).rglob('*') if f.suffix.lower() == '.pdf']
+        if not os.path.isdir(file):
+            yield file
+            continue
+        for root, dirs, names in os.walk(file):
+            dirs.sort()
+            for name in sorted(names):
+                if name.lower().endswith(".pdf"):
+                    yield os.path.join(root, name)
+
+
+def ingest_task(path):
+    """Reads and prepares a PDF file, runs in the --jobs workers. Returns
+    (row of prepare_pdf, None) or (None, error) if it isn't a póliza that
+    can be parsed."""
+    import fitz
+    with open(path, "rb") as of:
+        content = of.read()
+    try:
+        # old pólizas go to the partition of their date, not of today
+        return prepare_pdf(None, INGEST_URL, "hpolizapd", content), None
+    except (fitz.FileDataError, IndexError, ValueError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def ingest_worker(path):
+    """ingest_task in a --jobs worker, also returns the stages measured for --stats"""
+    return ingest_task(path), take_stats()
+
+
+def ingest(files, jobs=1):
+    """Add old pólizas to db.
+
+    Files are found lazily and prepared (expand, metadata, diff) by jobs
+    worker processes, with at most INGEST_INFLIGHT files per worker in
+    flight so memory stays bounded. The main process is the only writer and
+    commits in batches. Each PDF is written to the partition of its
+    fecha_desde. Every file ingested is recorded in ingest_progress with its
+    size and mtime, once its PDF is committed, so an interrupted ingest skips
+    them next time. A file that can't be parsed is recorded with its error
+    and skipped too, until it changes.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    create_cache_table()
+    storage = get_storage()
+    if jobs > 1:
+        # workers open their own connection, never share it across a fork
+        commit_storage()
+        export_templates()
+        close_storage()
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                       initargs=(global_stats is not None,))
+        # the pool forks on its first task, before the connection is open again
+        executor.submit(os.getpid).result()
+        storage = get_storage()
+    pending = {}
+    ingested = []  # ingest_progress rows of the files not committed yet
+    number = skipped = failed = 0
+
+    def commit():
+        # the partitions first, a file is never recorded without its PDF
+        commit_storage()
+        for row in ingested:
+            storage.write(
+                "INSERT OR REPLACE INTO ingest_progress (path, size, mtime, ingest_time, error) "
+                "VALUES (?, ?, ?, ?, ?)", row
+            )
+        storage.commit()
+        ingested.clear()
+
+    def save(path, stat, row, error):
+        nonlocal failed
+        if error:
+            print(f"Error ingesting '{path}': {error}")
+            failed += 1
+        elif row:
+            save_pdf(write_partition(document_time(row["metadata"])), "hpolizapd", row)
+        ingested.append((path, stat.st_size, stat.st_mtime, time.time(), error))
+        if len(ingested) >= storage.batch_size:
+            commit()
+
+    def wait_pending(limit):
+        while len(pending) > limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                (row, error), stages = future.result()
+                if stages:
+                    global_stats.merge(stages)
+                save(*pending.pop(future), row, error)
+
+    for path in walk_pdfs(files):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        done = storage.fetchone(
+            "SELECT 1 FROM ingest_progress WHERE path = ? AND size = ? AND mtime = ?",
+            (path, stat.st_size, stat.st_mtime),
+        )
+        if done:
+            skipped += 1
+            continue
+        print(path)
+        number += 1
+        if jobs > 1:
+            # back-pressure: don't read ahead of the workers
+            wait_pending(jobs * INGEST_INFLIGHT)
+            pending[executor.submit(ingest_worker, path)] = (path, stat)
         else:
-            pdf_files = [Path(file)]
-        for f in pdf_files:
-            print(f)
-            with f.open("rb") as of:
-                content = of.read()
-                cache_content("https://www.triunfonet.com.ar/gauswebtriunfo/servlet/hpolizapd?--", content)
-
-def cell2(ws, row=None, column=None, value=None, number_format=None, fill=None, font=BOLD, 
-          align=None, col_width=None):
-    cell = ws.cell(row=row, column=column, value=value)
-    if fill:
-        cell.fill = fill
-    if font:
-        cell.font = font
-    if number_format:
-        cell.number_format = number_format
-    if align:
-        cell.alignment = align
-    if col_width:
-        ws.column_dimensions[cell.column_letter].width = col_width
-    return cell
+            with pdf_lock:
+                save(path, stat, *ingest_task(path))
+    if jobs > 1:
+        wait_pending(0)
+        executor.shutdown()
+    commit()
+    print(f"Ingested {number - failed} files, {failed} failed, {skipped} already ingested")
+
+def excel_styles(wb):
+    """Adds the named styles of the --excel sheet to a workbook"""
+    import openpyxl
+    bold = openpyxl.styles.Font(bold=True)
+    for style in (
+        openpyxl.styles.NamedStyle(
+            name="header", font=bold,
+            alignment=openpyxl.styles.Alignment(horizontal='left', textRotation=30),
+        ),
+        openpyxl.styles.NamedStyle(name="date", font=bold, number_format='DD/MM/YYYY'),
+        openpyxl.styles.NamedStyle(name="number", font=bold, number_format='#,##'),
+        openpyxl.styles.NamedStyle(name="amount", font=bold, number_format='#,##0.00'),
+        openpyxl.styles.NamedStyle(name="text", font=bold),
+    ):
+        wb.add_named_style(style)
+
 
-def sort_key_excel(item):
-    date_parts = item[0]
-    year = int(date_parts[2])
-    month = int(date_parts[1])
-    day = int(date_parts[0])
-    return (year, month, day)
+def excel_cell(ws, value, style):
+    import openpyxl
+    cell = openpyxl.cell.WriteOnlyCell(ws, value=value)
+    cell.style = style
+    return cell
 
 def safefloat(n, thousands_sep=","):
     n = n.strip()
@@ -513,82 +3418,576 @@ def safefloat(n, thousands_sep=","):
     return r
 
 def excel():
-    """Generate an Excel sheet from the info in database"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT url FROM fetched_content WHERE url LIKE 'https://www.triunfonet.com.ar/gauswebtriunfo/servlet/hpolizapd%' order by rowid"
+    """Generate an Excel sheet from the info in database.
+
+    Rows are read in date order from the poliza_metadata index of every
+    partition, merged from their cursors and written to a write-only
+    workbook, so memory doesn't grow with the rows.
+    """
+    import openpyxl
+    # index documents cached before poliza_metadata existed, a no-op otherwise
+    backfill_metadata()
+    partitions = stream_partitions(
+        "SELECT fecha_desde, fecha_hasta, num_fac, suplemento, patente, premio, prima, "
+        "iva, af, iva_af, sellos, otros_imp, otros_grv, cuotas_soc FROM poliza_metadata "
+        f"WHERE {url_range(PDF_URL + 'hpolizapd')} AND name IS NOT NULL order by fecha_desde, rowid"
     )
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    row = 0
-    datos = []
-    while True:
-        result = cursor.fetchone()
-        if result is None:
-            break
-        dato = extract_file(result[0], excel=True)
-        datos.append(dato)
-        
-    sorted_data = sorted(datos, key=sort_key_excel)
-     # ~ return (fecha, num_fac, suplemento, patente, premio, prima, iva, iva_af),
-            # ~ af, sellos, otros_imp, otros_grv, cuotas_soc)
-    
-    row = 1
-    cell2(ws, row, 1, 'Fecha desde', font=BOLD, align=LEFT)
-    cell2(ws, row, 2, 'Fecha hasta', font=BOLD, align=LEFT)
-    cell2(ws, row, 3, 'Número póliza', font=BOLD, align=LEFT)
-    cell2(ws, row, 4, 'Suplemento', font=BOLD, align=LEFT)
-    cell2(ws, row, 5, 'Patente', font=BOLD, align=LEFT)
-    cell2(ws, row, 6, 'Total pagado', font=BOLD, align=LEFT)
-    cell2(ws, row, 7, 'Prima', font=BOLD, align=LEFT)
-    cell2(ws, row, 8, 'IVA', font=BOLD, align=LEFT)
-    cell2(ws, row, 9, 'Adic. Financiero', font=BOLD, align=LEFT)
-    cell2(ws, row, 10, 'IVA Adic. Financ.', font=BOLD, align=LEFT)
-    cell2(ws, row, 11, 'Sellos', font=BOLD, align=LEFT)
-    cell2(ws, row, 12, 'Otros Imp.', font=BOLD, align=LEFT)
-    cell2(ws, row, 13, 'Otros Grav.', font=BOLD, align=LEFT)
-    cell2(ws, row, 14, 'Cuotas sociales', font=BOLD, align=LEFT)
-   
-    for dato in sorted_data:
-        # ~ print (dato)
-        # ~ breakpoint()
-        row += 1
-        fecha_desde = dato[0][:3]
-        fecha_desde.reverse()
-        fecha_desde = "-".join(fecha_desde)
-        
-        fecha_hasta = dato[0][3:]
-        fecha_hasta.reverse()
-        fecha_hasta = "-".join(fecha_hasta)
-        
-        cell2(ws, row, 1, date.fromisoformat(fecha_desde), number_format='DD/MM/YYYY', col_width=11)
-        cell2(ws, row, 2, date.fromisoformat(fecha_hasta), number_format='DD/MM/YYYY', col_width=11)
-        cell2(ws, row, 3, dato[1], number_format = '#,##', col_width=11) #num
-        cell2(ws, row, 4, int(dato[2]) if dato[2] else None, col_width=4) #sup
-        cell2(ws, row, 5, dato[3], col_width=11) #pat
-        cell2(ws, row, 6, dato[4], number_format = '#,##0.00', col_width=11) #prem
-        cell2(ws, row, 7, dato[5], number_format = '#,##0.00', col_width=11) #prima
-        cell2(ws, row, 8, dato[6], number_format = '#,##0.00', col_width=11) #iva
-        cell2(ws, row, 9, dato[7], number_format = '#,##0.00', col_width=11) #af
-        cell2(ws, row, 10, dato[8], number_format = '#,##0.00', col_width=11) #ivaaf
-        cell2(ws, row, 11, dato[9], number_format = '#,##0.00', col_width=11) #sellos
-        cell2(ws, row, 12, dato[10], number_format = '#,##0.00', col_width=11) #oi
-        cell2(ws, row, 13, dato[11], number_format = '#,##0.00', col_width=11) #og
-        cell2(ws, row, 14, dato[12], number_format = '#,##0.00', col_width=11) #cuotas
+    cursor = heapq.merge(*partitions, key=lambda row: row[0] or "")
+    wb = openpyxl.Workbook(write_only=True)
+    excel_styles(wb)
+    ws = wb.create_sheet()
+    for column, (_, _, width) in enumerate(EXCEL_COLUMNS, 1):
+        ws.column_dimensions[openpyxl.utils.get_column_letter(column)].width = width
     ws.freeze_panes = 'A2'
-    wb.save("datos.xlsx") 
-    conn.close()
-
-def main():
-    if len(sys.argv) > 1 and sys.argv[1] == "--extract":
-        extract_files()
-    elif len(sys.argv) > 1 and sys.argv[1] == "--ingest":
-        ingest(sys.argv[2:])
-    elif len(sys.argv) > 1 and sys.argv[1] == "--excel":
+    ws.append([excel_cell(ws, header, "header") for header, _, _ in EXCEL_COLUMNS])
+    for dato in cursor:
+        dato = list(dato)
+        dato[0] = date.fromisoformat(dato[0])
+        dato[1] = date.fromisoformat(dato[1])
+        dato[3] = int(dato[3]) if dato[3] else None
+        ws.append([
+            excel_cell(ws, value, style)
+            for value, (_, style, _) in zip(dato, EXCEL_COLUMNS)
+        ])
+    with measure("excel.save"):
+        wb.save("datos.xlsx")
+
+
+def find_documents(filters, folder=None, limit=None):
+    """Looks documents up in the poliza_metadata of every partition, in
+    parallel, newest first.
+
+    filters may have a patente, a num_fac, vigente (a date between
+    fecha_desde and fecha_hasta) and desde/hasta (a range of fecha_desde),
+    dates in ISO format. Returns a list of dicts of the url and its
+    metadata. Raises ValueError for a malformed date or number.
+    """
+    # not the rows of unparseable PDFs, see backfill_metadata
+    conditions, params = ["name IS NOT NULL"], []
+    if filters.get("patente"):
+        conditions.append("patente = ?")
+        params.append(filters["patente"].strip().upper())
+    if filters.get("num_fac"):
+        num_fac = safefloat(filters["num_fac"], thousands_sep=".")
+        if num_fac == '':
+            raise ValueError(f"Invalid num_fac: {filters['num_fac']}")
+        conditions.append("num_fac = ?")
+        params.append(num_fac)
+    if filters.get("vigente"):
+        vigente = date.fromisoformat(filters["vigente"]).isoformat()
+        conditions.append("fecha_desde <= ? AND fecha_hasta >= ?")
+        params += [vigente, vigente]
+    if filters.get("desde"):
+        conditions.append("fecha_desde >= ?")
+        params.append(date.fromisoformat(filters["desde"]).isoformat())
+    if filters.get("hasta"):
+        conditions.append("fecha_desde <= ?")
+        params.append(date.fromisoformat(filters["hasta"]).isoformat())
+    if folder:
+        conditions.append("folder = ?")
+        params.append(folder)
+    sql = f"SELECT url, {', '.join(METADATA_FIELDS)} FROM poliza_metadata"
+    sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY fecha_desde DESC, rowid"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    # fecha_desde is the fourth column
+    rows = heapq.merge(*query_partitions(sql, params), key=lambda row: row[3] or "", reverse=True)
+    return [
+        dict(zip(("url",) + METADATA_FIELDS, row))
+        for row in (rows if limit is None else itertools.islice(rows, int(limit)))
+    ]
+
+
+def get_documents(filters, output="."):
+    """Saves the documents that match filters to the output folder, only
+    they are rebuilt (--get). Returns the exit status."""
+    create_cache_table()
+    if not any(filters.values()):
+        print("Use --patente, --num-fac, --vigente, --desde or --hasta")
+        return 2
+    try:
+        documents = find_documents(filters)
+    except ValueError as e:
+        print(e)
+        return 2
+    if not documents:
+        print("No documents found")
+        return 1
+    os.makedirs(output, exist_ok=True)
+    status = 0
+    for document in documents:
+        content = get_cached_content(document["url"])
+        if content is None:
+            # its metadata is indexed but the PDF is gone
+            print(f"Skipping '{document['url']}', its PDF is not cached")
+            status = 1
+            continue
+        filename = os.path.join(output, document["name"] + ".pdf")
+        file_save(filename, content, overwrite=True)
+        print(f"{filename}  {document['fecha_desde']}  {document['patente']}")
+    return status
+
+
+class ApiRequests:
+    """Read API of the serve command, mixed with http.server's
+    BaseHTTPRequestHandler by serve_api:
+
+    GET /polizas?patente=&num_fac=&vigente=&desde=&hasta=   pólizas as JSON
+    GET /documentos?...   the same for every type of document
+    GET /documento?url=   the PDF of a document, rebuilt on demand
+    """
+
+    def do_GET(self):
+        request = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(request.query).items()}
+        if request.path in ("/polizas", "/documentos"):
+            self.send_documents(query, "pólizas" if request.path == "/polizas" else None)
+        elif request.path == "/documento":
+            self.send_pdf(query.get("url", ""))
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_documents(self, query, folder):
+        try:
+            documents = find_documents(query, folder, DOCUMENTS_LIMIT)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        for document in documents:
+            document["pdf"] = "/documento?url=" + quote(document["url"], safe="")
+        self.send_json(200, documents)
+
+    def send_pdf(self, url):
+        result = None
+        if re.search(REGEX_PDFURL, url):
+            storage, result = find_row(SELECT_CACHED, (url,))
+        if result is None:
+            self.send_json(404, {"error": "Not found"})
+            return
+        # the hash of the PDF, known without rebuilding it
+        etag = f'"{content_key(storage, *result[:4])}"'
+        if_none_match = [
+            tag.strip().removeprefix("W/")
+            for tag in self.headers.get("If-None-Match", "").split(",")
+        ]
+        if etag in if_none_match or "*" in if_none_match:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        # PyMuPDF is not thread safe
+        with pdf_lock:
+            content = get_cached_content(url)
+        if content is None:
+            # removed since the lookup above
+            self.send_json(404, {"error": "Not found"})
+            return
+        metadata = load_metadata(url)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        # always revalidated, a 304 costs one indexed lookup
+        self.send_header("Cache-Control", "private, no-cache")
+        if metadata:
+            self.send_header(
+                "Content-Disposition",
+                f"inline; filename*=UTF-8''{quote(metadata['name'] + '.pdf')}",
+            )
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve_api(host=API_HOST, port=API_PORT):
+    """Serves the read API of ApiRequests until interrupted"""
+    import http.server
+    create_cache_table()
+    handler = type("ApiHandler", (ApiRequests, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    print(f"Serving on http://{host}:{port}/polizas")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def database_stats():
+    """Prints what the database holds: documents and bytes by type and format,
+    bases, chunks, metadata, partitions and the last scan"""
+    create_cache_table()
+    storage = get_storage()
+    documents = {}
+    for rows in query_partitions(
+        "SELECT url, format, codec, length(content) FROM fetched_content "
+        f"WHERE {url_range('https://')}"
+    ):
+        for url, format, codec, size in rows:
+            urltype = re.search(REGEX_PDFURL, url)
+            if urltype:
+                key = (urltype[1], format or "bsdiff", codec or "-")
+            else:
+                key = (LISTINGS, "json", codec or "-")
+            count, total = documents.get(key, (0, 0))
+            documents[key] = (count + 1, total + (size or 0))
+    print(f"{'type':<20}{'format':<10}{'codec':<8}{'documents':>10}{'MB':>10}{'bytes/doc':>11}")
+    for (urltype, format, codec), (count, total) in sorted(documents.items()):
+        print(f"{urltype:<20}{format:<10}{codec:<8}{count:>10}{total / 1e6:>10.2f}"
+              f"{total // count:>11}")
+    for label, sql in (
+        ("Templates", f"SELECT count(*), sum(length(content)) FROM fetched_content WHERE {TEMPLATE_URLS}"),
+        ("Delta bases", "SELECT count(*), sum(length(content)) FROM delta_bases"),
+        ("Chunks", "SELECT count(*), sum(length(data)) FROM chunks"),
+        ("Dictionaries", "SELECT count(*), sum(length(data)) FROM codec_dicts"),
+    ):
+        results = [rows[0] for rows in query_partitions(sql)]
+        count = sum(result[0] for result in results)
+        total = sum(result[1] or 0 for result in results)
+        print(f"{label}: {count}, {total / 1e6:.2f} MB")
+    indexed = sum(rows[0][0] for rows in query_partitions(
+        "SELECT count(*) FROM poliza_metadata WHERE name IS NOT NULL"
+    ))
+    print(f"Indexed documents: {indexed}")
+    print(f"Extracted files: {storage.fetchone('SELECT count(*) FROM extraction_manifest')[0]}")
+    print(f"Downloads to retry: {storage.fetchone('SELECT count(*) FROM download_retries')[0]}")
+    for mailbox, last_uid, sync_time in storage.query(
+        "SELECT mailbox, last_uid, sync_time FROM imap_sync"
+    ):
+        print(f"Last scan of {mailbox}: {time.ctime(sync_time)}, up to uid {last_uid}")
+    size = 0
+    for partition in get_partitions():
+        size += database_size(partition.filename)
+        if partition is not storage:
+            print(f"Partition {partition.name}: {partition.filename}, "
+                  f"{database_size(partition.filename) / 1e6:.2f} MB"
+                  + (", frozen" if partition.frozen else ""))
+    print(f"Database: {size / 1e6:.2f} MB")
+
+
+def split_partitions():
+    """Moves the documents of the main file to the partition of their
+    download time, or of their fecha_desde for ingested pólizas, after
+    setting PARTITION_BY.
+
+    The PDFs are diffed again against the bases of their partition, so each
+    partition is a database of its own. Documents are committed to their
+    partition before they are deleted from the main file, in batches.
+    """
+    create_cache_table()
+    if PARTITION_BY is None:
+        print("Set PARTITION_BY to split the main file in partitions")
+        return 1
+    main = get_storage()
+    urls = [url for url, in main.query(
+        f"SELECT url FROM fetched_content WHERE {url_range('https://')} order by rowid"
+    ).fetchall()]
+    for start in range(0, len(urls), main.batch_size):
+        batch = urls[start:start + main.batch_size]
+        for url in batch:
+            filename, content, fetch_time, format, base_id, raw_sha256, sha256, codec, dict_id = (
+                main.fetchone(
+                    "SELECT filename, content, fetch_time, format, base_id, raw_sha256, sha256, "
+                    "codec, dict_id FROM fetched_content WHERE url = ?", (url,)
+                )
+            )
+            metadata = main.fetchone(SELECT_METADATA, (url,))
+            if url.startswith(INGEST_URL) and metadata:
+                # ingested pólizas go to the year of their fecha_desde, as in ingest
+                storage = write_partition(
+                    document_time(dict(zip(METADATA_FIELDS, metadata))) or fetch_time
+                )
+            else:
+                storage = write_partition(fetch_time)
+            urltype = blob_urltype(url)
+            if urltype == LISTINGS:
+                content, codec, dict_id = encode_blob(
+                    storage, decode_blob(main, content, codec, dict_id), LISTINGS
+                )
+            else:
+                expanded = get_expanded(main, url, content, format, base_id, codec, dict_id)
+                if format == "chunks":
+                    for i in range(0, len(content), CHUNK_HASH_SIZE):
+                        main.write("UPDATE chunks SET refcount = refcount - 1 WHERE hash = ?",
+                                   (content[i:i + CHUNK_HASH_SIZE],))
+                if DELTA_FORMAT == "chunks":
+                    content, format, base_id, codec, dict_id = (
+                        store_chunks(storage, expanded), "chunks", None, None, None
+                    )
+                else:
+                    base_id, template = choose_base(storage, urltype, expanded)
+                    format = "xref" if DELTA_FORMAT == "xref" else "bsdiff"
+                    content, codec, dict_id = diff_pdf(
+                        storage, urltype, base_id, template, expanded, format
+                    )
+            storage.write(INSERT, (url, filename, content, fetch_time, format, base_id,
+                                   raw_sha256, sha256, codec, dict_id))
+            if metadata:
+                storage.write(INSERT_METADATA, (url, *metadata))
+        for storage in get_partitions()[1:]:
+            if not storage.frozen:
+                storage.commit()
+        for url in batch:
+            main.write("DELETE FROM poliza_metadata WHERE url = ?", (url,))
+            main.write("DELETE FROM fetched_content WHERE url = ?", (url,))
+        main.write("DELETE FROM chunks WHERE refcount <= 0")
+        main.commit()
+        print(f"Moved {start + len(batch)}/{len(urls)} documents")
+    list_partitions()
+    print("Run VACUUM in the main file to reclaim the space of the moved documents.")
+    return 0
+
+
+def database_size(filename):
+    """Bytes of a database file and of its write-ahead log"""
+    wal = filename + "-wal"
+    return os.path.getsize(filename) + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+
+def list_partitions():
+    """Prints the partitions of the catalog with their documents and size"""
+    create_cache_table()
+    counts = query_partitions(f"SELECT count(*) FROM fetched_content WHERE {url_range(PDF_URL)}")
+    print(f"{'partition':<20}{'file':<20}{'documents':>10}{'MB':>10}  state")
+    for partition, rows in zip(get_partitions(), counts):
+        state = "frozen" if partition.frozen else ""
+        if partition.name == partition_name():
+            state = "new documents"
+        print(f"{partition.name:<20}{partition.filename:<20}{rows[0][0]:>10}"
+              f"{database_size(partition.filename) / 1e6:>10.2f}  {state}")
+
+
+def freeze_partition(name, frozen=True):
+    """Makes a partition read-only (or writable again, with frozen False).
+
+    Freezing compacts the file and leaves it in rollback journal mode, so it
+    is a single file that can be backed up or moved as is. The catalog keeps
+    it as frozen and it is opened read-only and immutable from then on.
+    """
+    create_cache_table()
+    if name == MAIN_PARTITION:
+        print(f"The {MAIN_PARTITION} partition holds the catalog, it can't be frozen")
+        return 1
+    storage = get_partition(name)
+    if storage.frozen == frozen:
+        print(f"Partition {name} is already {'frozen' if frozen else 'writable'}")
+        return 1
+    if frozen and name == partition_name():
+        print(f"New documents go to {name}, it can't be frozen")
+        return 1
+    storage.close()
+    if frozen:
+        conn = sqlite3.connect(storage.filename)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute("VACUUM")
+        conn.execute("ANALYZE")
+        conn.close()
+        os.chmod(storage.filename, 0o444)
+    else:
+        os.chmod(storage.filename, 0o644)
+    main = get_storage()
+    main.write("UPDATE partitions SET frozen = ? WHERE name = ?", (int(frozen), name))
+    main.commit()
+    global_partitions[name] = Storage(storage.filename, name=name, frozen=frozen)
+    print(f"Partition {name} is {'frozen' if frozen else 'writable'}")
+    return 0
+
+
+COMMANDS = (
+    "scan", "ingest", "extract", "excel", "stats", "get", "serve",
+    "backfill", "dedupe", "repack", "migrate-chunks", "recompress", "partitions",
+)
+
+
+def stage_option(value):
+    """Parses a --stage NAME=N[:QUEUE] into (name, concurrency, queue size)"""
+    match = re.fullmatch(r"(\w+)=(\d+)(?::(\d+))?", value)
+    if not match or match[1] not in SCAN_STAGES:
+        raise argparse.ArgumentTypeError(f"expected NAME=N[:QUEUE] with NAME in {', '.join(SCAN_STAGES)}")
+    name, concurrency, queue_size = match[1], int(match[2]), match[3]
+    if name in ("imap", "write") and concurrency != 1:
+        raise argparse.ArgumentTypeError(f"the {name} stage has a single connection")
+    if concurrency < 1:
+        raise argparse.ArgumentTypeError("a stage needs at least one worker")
+    return name, concurrency, int(queue_size) if queue_size else SCAN_STAGES[name][1]
+
+
+def get_parser():
+    """The argparse parser of the subcommands"""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--batch", type=int, default=BATCH_SIZE,
+                        help=f"rows written per transaction (default {BATCH_SIZE})")
+    common.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="folder to also keep the rebuilt PDFs on disk")
+    common.add_argument("--stats", action="store_true",
+                        help="print the time and bytes of each stage")
+    common.add_argument("--stats-file", metavar="FILE",
+                        help="save the stage stats to a JSON or Prometheus (.prom) file")
+    common.add_argument("--profile", metavar="FILE", help="run under cProfile and save the profile")
+
+    parser = argparse.ArgumentParser(
+        prog="pytriunfo.py",
+        description="Downloads and stores the documents of Triunfo Seguros emails.",
+        epilog="Without a command it scans, the old --extract style options still work.",
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    command = commands.add_parser("scan", parents=[common], help="download the documents of new emails")
+    command.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                         help=f"concurrent downloads (default {DOWNLOAD_WORKERS})")
+    command.add_argument("--rate", type=float, default=HOST_RATE,
+                         help=f"requests per second to each host, 0 is unlimited (default {HOST_RATE})")
+    command.add_argument("--async", dest="scan_async", action="store_true",
+                         help="overlap reading, downloading, preparing and saving in stages")
+    command.add_argument("--jobs", type=int, default=SCAN_STAGES["prepare"][0],
+                         help="worker processes preparing the PDFs with --async")
+    command.add_argument("--stage", type=stage_option, action="append", default=[],
+                         metavar="NAME=N[:QUEUE]",
+                         help="concurrency and queue size of an --async stage: "
+                              + ", ".join(SCAN_STAGES))
+    command = commands.add_parser("ingest", parents=[common], help="add PDF files of old pólizas")
+    command.add_argument("paths", nargs="+", help="PDF files or folders")
+    command.add_argument("--jobs", type=int, default=1, help="worker processes")
+    command = commands.add_parser("extract", parents=[common], help="save the new PDFs to extracted_pdfs")
+    command.add_argument("--jobs", type=int, default=1, help="worker processes")
+    command.add_argument("--verify", action="store_true",
+                         help="only check the extracted files against the manifest")
+    commands.add_parser("excel", parents=[common], help="save the pólizas data to datos.xlsx")
+    commands.add_parser("stats", parents=[common], help="show what the database holds")
+    command = commands.add_parser("get", parents=[common], help="save the documents that match")
+    command.add_argument("--patente")
+    command.add_argument("--num-fac", help="número de póliza")
+    command.add_argument("--vigente", metavar="DATE", help="valid on this date, YYYY-MM-DD")
+    command.add_argument("--desde", metavar="DATE", help="starting on or after this date")
+    command.add_argument("--hasta", metavar="DATE", help="starting on or before this date")
+    command.add_argument("--output", default=".", help="folder of the PDFs")
+    command = commands.add_parser("serve", parents=[common], help="serve the read HTTP API")
+    command.add_argument("--host", default=API_HOST)
+    command.add_argument("--port", type=int, default=API_PORT)
+    commands.add_parser("backfill", parents=[common], help="index the data of old documents")
+    commands.add_parser("dedupe", parents=[common], help="report documents stored twice")
+    command = commands.add_parser("repack", parents=[common],
+                                  help="re-diff documents against their best base")
+    command.add_argument("--format", choices=("bsdiff", "xref"),
+                         help="convert the documents to this delta format")
+    commands.add_parser("migrate-chunks", parents=[common], help="convert bsdiff rows to chunks")
+    command = commands.add_parser("recompress", parents=[common],
+                                  help="rewrite the stored blobs with the blob codec")
+    command.add_argument("--codec", choices=("zstd", "none"), default=BLOB_CODEC or "none",
+                         help=f"codec of the blobs (default {BLOB_CODEC})")
+    command.add_argument("--retrain", action="store_true",
+                         help="train new dictionaries from the latest blobs")
+    command = commands.add_parser("partitions", parents=[common],
+                                  help="list, freeze or split the database partitions")
+    command.add_argument("--freeze", metavar="NAME", help="make a partition read-only")
+    command.add_argument("--thaw", metavar="NAME", help="make a frozen partition writable")
+    command.add_argument("--split", action="store_true",
+                         help="move the documents of the main file to their partition")
+    return parser
+
+
+# the commands of the old command line, --stats is the stage stats option
+LEGACY_COMMANDS = (
+    "--extract", "--ingest", "--excel", "--dedupe", "--repack", "--migrate-chunks",
+    "--backfill", "--get", "--serve", "--recompress", "--partitions",
+)
+
+
+def command_line(argv):
+    """Maps the old command line (--extract, --ingest... or nothing for the
+    scan) to the subcommands"""
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        for i, arg in enumerate(argv):
+            if arg in LEGACY_COMMANDS:
+                return [arg[2:]] + argv[:i] + argv[i + 1:]
+        return ["scan"] + argv
+    return argv
+
+
+def run_command(args):
+    """Runs a parsed command, returns the exit status"""
+    if args.command == "extract" and args.verify:
+        return 1 if verify_extraction() else 0
+    elif args.command == "extract":
+        extract_files(jobs=args.jobs)
+    elif args.command == "ingest":
+        ingest(args.paths, jobs=args.jobs)
+    elif args.command == "excel":
         excel()
+    elif args.command == "stats":
+        database_stats()
+    elif args.command == "dedupe":
+        dedupe()
+    elif args.command == "repack":
+        repack(args.format)
+    elif args.command == "migrate-chunks":
+        migrate_chunks()
+    elif args.command == "recompress":
+        return recompress(retrain=args.retrain)
+    elif args.command == "partitions" and args.freeze:
+        return freeze_partition(args.freeze)
+    elif args.command == "partitions" and args.thaw:
+        return freeze_partition(args.thaw, frozen=False)
+    elif args.command == "partitions" and args.split:
+        return split_partitions()
+    elif args.command == "partitions":
+        list_partitions()
+    elif args.command == "get":
+        filters = {
+            key: getattr(args, key) for key in ("patente", "num_fac", "vigente", "desde", "hasta")
+        }
+        return get_documents(filters, args.output)
+    elif args.command == "serve":
+        serve_api(args.host, args.port)
+    elif args.command == "backfill":
+        print(f"Indexed {backfill_metadata()} documents")
     else:
         fetch_and_scan_emails()
+    return 0
+
+
+def main(argv=None):
+    global BATCH_SIZE, DOWNLOAD_WORKERS, HOST_RATE, CACHE_DIR, BLOB_CODEC, SCAN_ASYNC
+    args = get_parser().parse_args(command_line(sys.argv[1:] if argv is None else argv))
+    BATCH_SIZE = args.batch
+    DOWNLOAD_WORKERS = getattr(args, "workers", DOWNLOAD_WORKERS)
+    HOST_RATE = getattr(args, "rate", HOST_RATE) or None
+    if args.command == "scan":
+        SCAN_ASYNC = args.scan_async
+        SCAN_STAGES["download"][0] = DOWNLOAD_WORKERS
+        SCAN_STAGES["prepare"][0] = args.jobs
+        for name, concurrency, queue_size in args.stage:
+            SCAN_STAGES[name] = [concurrency, queue_size]
+    CACHE_DIR = args.cache_dir
+    if getattr(args, "codec", None):
+        BLOB_CODEC = None if args.codec == "none" else args.codec
+    if args.stats or args.stats_file:
+        enable_stats()
+    if args.profile:
+        import cProfile
+        # only this process, not the --jobs workers
+        profiler = cProfile.Profile()
+        try:
+            status = profiler.runcall(run_command, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(f"Profile saved to {args.profile}, see python -m pstats {args.profile}")
+    else:
+        status = run_command(args)
+    if global_stats is not None:
+        if args.stats:
+            global_stats.report()
+        if args.stats_file:
+            global_stats.save(args.stats_file)
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()